@@ -0,0 +1,391 @@
+# general
+import numpy as np
+import sys, os, json
+
+# specific
+from PIL import Image
+from time import time
+from tempfile import mkdtemp
+from shutil import rmtree
+from subprocess import Popen, PIPE
+
+# other spims
+from match import match_master_ten_thousand
+from compare import choose_weapon
+from ims import Pattern
+from run import pop_flag
+import tracing
+
+# source shapes (rows, columns) the workloads come in
+SIZES = {'thumb':(120, 160), 'vga':(480, 640), 'hd':(1080, 1920),
+         '4k':(2160, 3840), '8k':(4320, 7680)}
+DEFAULT_SIZES = ['thumb', 'vga', 'hd']
+
+# textures keep to this range so that the planted colours are unique
+TEXTURE = (32, 223)
+SOLID = (250, 10, 10)
+PIXEL = (10, 250, 250)
+
+# how much bigger the scaled pattern is planted in its source
+SCALE = 2.5
+
+# a workload is a regression when it is this much slower than the
+# baseline (and not just by noise)
+TOLERANCE = 1.25
+NOISE = .05
+
+# modules a cold start imports, in the order it does (the last two only
+# when scaling), and the number of fresh interpreters to take the best
+# time of
+STARTUP_IMPORTS = ['bin.run', 'bin.match', 'bin.scale', 'scipy.misc']
+STARTUP_RUNS = 5
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# run by a fresh interpreter, prints the seconds each import adds
+IMPORT_TIMER = """
+import sys
+from time import time
+t = time()
+for name in sys.argv[1:]:
+    __import__(name)
+    t2 = time()
+    sys.stdout.write('%s %r\\n' % (name, t2 - t))
+    t = t2
+"""
+
+def texture(shape, rng, grain=8):
+    """Smooth random RGB texture, so that crops of it are distinctive.
+
+    ----------
+    shape : tuple[int]
+       Rows and columns of the texture.
+
+    rng : RandomState
+       Where the randomness comes from.
+
+    grain : int, optional
+       Rough size in pixels of the blobs the texture is made of.
+
+    ----------
+    out : ndarray[uint8]
+       The texture.
+    """
+    h, w = shape
+    coarse = rng.randint(0, 256, (max(h // grain, 2), max(w // grain, 2), 3))
+    im = Image.fromarray(coarse.astype(np.uint8)).resize((w, h),
+                                                          Image.BICUBIC)
+    a = np.array(im, dtype=float) + rng.normal(0, 8, (h, w, 3))
+    lo, hi = TEXTURE
+    return (lo + np.clip(a, 0, 255) * (hi - lo) / 255.).astype(np.uint8)
+
+def save(a, path, **kwargs):
+    Image.fromarray(a).save(path, **kwargs)
+
+def key_line(pattern, source, shape, x, y):
+    """Line of a key, as the match would be printed."""
+    return (pattern + ' matches ' + source + ' at ' + str(shape[1]) + 'x'
+            + str(shape[0]) + '+' + str(x) + '+' + str(y) + '\n')
+
+def plant(d, size, seed=0):
+    """Generate the workloads of one size, with their keys.
+
+    Writes d/P and d/S with an exact crop, a solid colour block, a
+    single pixel, a crop out of a JPEG recompressed source and a crop
+    of a fine grained texture at an odd offset, and
+    d/scaled/P and d/scaled/S with a pattern planted SCALE times bigger.
+    The planted matches go in d/key and d/scaled/key in the format of
+    test/A*_key.
+
+    ----------
+    d : str
+       Directory to write to.
+
+    size : str
+       Key of SIZES.
+
+    seed : int, optional
+       Seed of the random textures and positions.
+    """
+    rng = np.random.RandomState(seed)
+    h, w = SIZES[size]
+    ph, pw = max(h // 6, 4), max(w // 6, 4)
+    key = []
+
+    for sub in ['P', 'S', 'scaled/P', 'scaled/S']:
+        if not os.path.isdir(os.path.join(d, sub)):
+            os.makedirs(os.path.join(d, sub))
+
+    def spot(shape):
+        return (rng.randint(0, w - shape[1] + 1),
+                rng.randint(0, h - shape[0] + 1))
+
+    # exact crop
+    s = texture((h, w), rng)
+    x, y = spot((ph, pw))
+    save(s, os.path.join(d, 'S', 'crop.png'))
+    save(s[y:y+ph, x:x+pw], os.path.join(d, 'P', 'crop.png'))
+    key.append(key_line('crop.png', 'crop.png', (ph, pw), x, y))
+
+    # solid colour
+    s = texture((h, w), rng)
+    x, y = spot((ph, pw))
+    s[y:y+ph, x:x+pw] = SOLID
+    save(s, os.path.join(d, 'S', 'solid.png'))
+    save(np.tile(np.array(SOLID, np.uint8), (ph, pw, 1)),
+         os.path.join(d, 'P', 'solid.png'))
+    key.append(key_line('solid.png', 'solid.png', (ph, pw), x, y))
+
+    # single pixel
+    s = texture((h, w), rng)
+    x, y = spot((1, 1))
+    s[y, x] = PIXEL
+    save(s, os.path.join(d, 'S', 'pixel.png'))
+    save(np.array([[PIXEL]], np.uint8), os.path.join(d, 'P', 'pixel.png'))
+    key.append(key_line('pixel.png', 'pixel.png', (1, 1), x, y))
+
+    # crop out of a recompressed source
+    s = texture((h, w), rng)
+    x, y = spot((ph, pw))
+    save(s, os.path.join(d, 'S', 'jpeg.jpg'), quality=85)
+    save(s[y:y+ph, x:x+pw], os.path.join(d, 'P', 'jpeg.png'))
+    key.append(key_line('jpeg.png', 'jpeg.jpg', (ph, pw), x, y))
+
+    # fine grained crop at an odd offset, so never on the pyramid's
+    # grid; drawn from its own seed to leave the workloads above as
+    # they were
+    frng = np.random.RandomState(seed + 1)
+    s = texture((h, w), frng, grain=2)
+    x = 2 * frng.randint(0, (w - pw + 1) // 2) + 1
+    y = 2 * frng.randint(0, (h - ph + 1) // 2) + 1
+    save(s, os.path.join(d, 'S', 'fine.png'))
+    save(s[y:y+ph, x:x+pw], os.path.join(d, 'P', 'fine.png'))
+    key.append(key_line('fine.png', 'fine.png', (ph, pw), x, y))
+
+    with open(os.path.join(d, 'key'), 'w') as fp:
+        fp.writelines(key)
+
+    # scaled up, keeping the (2:3) aspect ratio of the pattern
+    k = max(h // 40, 2)
+    sp = texture((2 * k, 3 * k), rng)
+    kb = int(round(k * SCALE))
+    big = (2 * kb, 3 * kb)
+    s = texture((h, w), rng)
+    x, y = spot(big)
+    s[y:y+big[0], x:x+big[1]] = np.array(
+        Image.fromarray(sp).resize((big[1], big[0]), Image.BILINEAR))
+    save(s, os.path.join(d, 'scaled', 'S', 'scaled.png'))
+    save(sp, os.path.join(d, 'scaled', 'P', 'scaled.png'))
+    with open(os.path.join(d, 'scaled', 'key'), 'w') as fp:
+        fp.write(key_line('scaled.png', 'scaled.png', big, x, y))
+
+def startup(runs=STARTUP_RUNS):
+    """Cold start costs, each the best of runs fresh interpreters.
+
+    ----------
+    runs : int, optional
+       Number of fresh interpreters to time.
+
+    ----------
+    out : dict
+       Wall time of a spims process turning down an empty command line,
+       and the seconds each of STARTUP_IMPORTS adds on top of the ones
+       before it, as results of bench.
+    """
+    best = {}
+    def keep(name, t):
+        best[name] = min(best.get(name, t), t)
+    for i in range(runs):
+        t0 = time()
+        Popen([sys.executable, os.path.join(ROOT, 'spims')], cwd=ROOT,
+              stdout=PIPE, stderr=PIPE).communicate()
+        keep('startup', time() - t0)
+        out, err = Popen([sys.executable, '-c', IMPORT_TIMER] 
+                         + STARTUP_IMPORTS, cwd=ROOT, stdout=PIPE,
+                         stderr=PIPE).communicate()
+        if len(out.split()) != 2 * len(STARTUP_IMPORTS):
+            sys.stderr.write('IOError: Could not import spims\n' + err)
+            sys.exit(1)
+        for line in out.splitlines():
+            name, t = line.split()
+            keep('import/' + name.split('.')[-1], float(t))
+    return dict((name, {'time':t}) for name, t in best.items())
+
+def listing(d):
+    return sorted(os.path.join(d, x) for x in os.listdir(d))
+
+def run_workload(d, scaling=False, pyramid=False, jobs=1):
+    """Match one workload and score it against its key.
+
+    ----------
+    d : str
+       Directory with P, S and key, see plant.
+
+    scaling : Boolean, optional
+       if True, match with scaling on
+
+    pyramid : Boolean, optional
+       if True, match coarse to fine
+
+    jobs : int, optional
+       number of worker processes
+
+    ----------
+    out : dict
+       Wall time, seconds per engine and per stage (see tracing; stages
+       inside other stages count in both), recall, precision and the 
+       missed and false matches.
+    """
+    patterns = listing(os.path.join(d, 'P'))
+    sources = listing(os.path.join(d, 'S'))
+    with open(os.path.join(d, 'key')) as fp:
+        key = fp.readlines()
+
+    engines = [choose_weapon(Pattern(p)).__name__ for p in patterns]
+    per = {}
+    found = []
+    tracing.ON = True
+    tracing.drain()
+    t0 = time()
+    # pairs come out source by source, in the order of the patterns
+    for i, (ms, t) in enumerate(match_master_ten_thousand(
+            sources, patterns, scaling=scaling, pyramid=pyramid, 
+            jobs=jobs)):
+        engine = engines[i % len(patterns)]
+        per[engine] = per.get(engine, 0) + t
+        found += [str(m) for m in ms]
+    wall = time() - t0
+    tracing.ON = False
+
+    stages = {}
+    for rec in tracing.drain():
+        if 'seconds' in rec:
+            stages[rec['stage']] = stages.get(rec['stage'], 0) + rec['seconds']
+
+    hits = [m for m in found if m in key]
+    return {'time':wall, 'engines':per, 'stages':stages,
+            'recall':len(hits) / float(max(len(key), 1)),
+            'precision':len(hits) / float(max(len(found), 1)),
+            'missed':[m for m in key if m not in found],
+            'false':[m for m in found if m not in key]}
+
+def regressions(results, baseline):
+    """Workloads that got slower or worse than in the baseline.
+
+    ----------
+    results, baseline : dict
+       Results of bench, by workload name.
+
+    ----------
+    out : list[str]
+       One line per regression.
+    """
+    out = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        new, old = results[name], baseline[name]
+        if new['time'] > old['time'] * TOLERANCE + NOISE:
+            out.append('%s: %.3fs, was %.3fs\n'
+                       % (name, new['time'], old['time']))
+        for score in ['recall', 'precision']:
+            if score in new and score in old and new[score] < old[score]:
+                out.append('%s: %s %.2f, was %.2f\n'
+                           % (name, score, new[score], old[score]))
+    return out
+
+def bench(sizes=DEFAULT_SIZES, root=None, jobs=1, out=sys.stdout):
+    """Generate (if need be) and run the workloads of the given sizes.
+
+    ----------
+    sizes : list[str]
+       Keys of SIZES.
+
+    root : str, optional
+       Directory to keep the workloads in between runs; a temporary
+       one, removed afterwards, if None.
+
+    jobs : int, optional
+       number of worker processes
+
+    out : file, optional
+       Where the report goes.
+
+    ----------
+    out : dict
+       Results of startup and run_workload, by workload name.
+    """
+    temp = root is None
+    if temp:
+        root = mkdtemp(prefix='spims-bench-')
+    try:
+        results = startup()
+        for name in sorted(results):
+            out.write('%-14s %8.3fs\n' % (name, results[name]['time']))
+
+        for size in sizes:
+            d = os.path.join(root, size)
+            if not os.path.isfile(os.path.join(d, 'scaled', 'key')):
+                plant(d, size)
+            # the pyramid has to find what the plain pass does, the crop out
+            # of the recompressed JPEG and the one off its grid included
+            scaled = os.path.join(d, 'scaled')
+            for name, wd, opts in [(size, d, {}),
+                                   (size + '/pyramid', d, {'pyramid':True}),
+                                   (size + '/scaled', scaled,
+                                    {'scaling':True})]:
+                r = run_workload(wd, jobs=jobs, **opts)
+                results[name] = r
+                out.write('%-14s %8.3fs  recall %.2f  precision %.2f  %s\n'
+                          % (name, r['time'], r['recall'], r['precision'],
+                             '  '.join('%s %.3fs' % e
+                                       for e in sorted(r['engines'].items()))))
+                out.write('%14s %s\n' % ('', '  '.join(
+                    '%s %.3fs' % e for e in sorted(r['stages'].items()))))
+                for m in r['missed']:
+                    out.write('   missed ' + m)
+                for m in r['false']:
+                    out.write('   false  ' + m)
+                out.flush()
+    finally:
+        if temp:
+            rmtree(root, ignore_errors=True)
+    return results
+
+def main(opt):
+    """Command line entry of the benchmarks.
+
+    opt : list
+       options from command line: --sizes <a,b,..>, --dir <dir>,
+       --save <file>, --baseline <file> and -j/--jobs <n>
+
+    Exits with 1 if anything regressed against the baseline.
+    """
+    opt = list(opt)
+    sizes = pop_flag(opt, ['--sizes'], str)
+    sizes = DEFAULT_SIZES if sizes is None else sizes.split(',')
+    for size in sizes:
+        if size not in SIZES:
+            sys.stderr.write('IOError: Expected sizes among '
+                             + ', '.join(sorted(SIZES)) + '\n')
+            sys.exit(1)
+    root = pop_flag(opt, ['--dir'], str)
+    savef = pop_flag(opt, ['--save'], str)
+    basef = pop_flag(opt, ['--baseline'], str)
+    jobs = pop_flag(opt, ['-j', '--jobs'], int) or 1
+    if len(opt) != 0:
+        sys.stderr.write('IOError: Malformed input\n')
+        sys.exit(1)
+
+    results = bench(sizes, root, jobs)
+
+    if savef is not None:
+        with open(savef, 'w') as fp:
+            json.dump(results, fp, indent=1, sort_keys=True)
+
+    if basef is not None:
+        with open(basef) as fp:
+            worse = regressions(results, json.load(fp))
+        sys.stdout.write('## REGRESSIONS ##\n')
+        sys.stdout.writelines(worse)
+        if len(worse) > 0:
+            sys.exit(1)
@@ -0,0 +1,115 @@
+
+# general
+import numpy as np
+import os
+
+# specific
+from hashlib import sha1
+from tempfile import mkstemp
+
+# other spims
+from utility import lazyprop
+import fourier
+
+# directory of the on-disk cache, None to go without
+CACHE_DIR = None
+
+# anything that changes what gets stored goes in here so that old
+# entries are never picked up
+PARAMS = 'spims-1'
+
+def stash_dir(path):
+    """Directory in the cache for the image at path.
+
+    Keyed by the contents of the file together with PARAMS and the
+    precision of the spectra, so renamed or copied files still hit and
+    edited files never do.
+
+    ----------
+    path : str
+       Path to the image file.
+
+    ----------
+    out : str
+       Directory holding the stored arrays of the image, or None if 
+       the cache is off or the file cannot be read.
+    """
+    if CACHE_DIR is None:
+        return None
+
+    h = sha1(PARAMS + ':' + fourier.PRECISION)
+    try:
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(2**20), ''):
+                h.update(chunk)
+    except IOError:
+        return None
+
+    d = os.path.join(CACHE_DIR, h.hexdigest())
+    try:
+        os.makedirs(d)
+    except OSError:
+        if not os.path.isdir(d):
+            raise
+    return d
+
+def load(d, name):
+    """Memory map a stored array, or None if it was never stored."""
+    try:
+        return np.load(os.path.join(d, name + '.npy'), mmap_mode='r')
+    except IOError:
+        return None
+
+def save(d, name, a):
+    """Store an array, atomically so concurrent runs can share d."""
+    fd, tmp = mkstemp(dir=d, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as fp:
+        np.save(fp, a)
+    os.rename(tmp, os.path.join(d, name + '.npy'))
+
+def stashed(d, names, make):
+    """Load some stored arrays, making and storing them if need be.
+
+    ----------
+    d : str
+       Directory from stash_dir, or None to just call make.
+
+    names : list[str]
+       Names of the arrays.
+
+    make : function
+       Computes the arrays (a tuple in the order of names).
+
+    ----------
+    out : tuple[ndarray]
+       The arrays, memory mapped when they come from the cache.
+    """
+    if d is None:
+        return make()
+
+    vals = [load(d, name) for name in names]
+    if any(v is None for v in vals):
+        for name, v in zip(names, make()):
+            save(d, name, v)
+        vals = [load(d, name) for name in names]
+    return tuple(vals)
+
+class stashedprop(lazyprop):
+    """lazyprop that is also kept in the on-disk cache.
+
+    Only images with a stash directory (see stash_dir) go to disk,
+    everything else behaves like a plain lazyprop.
+    """
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        if obj.stash is None:
+            return lazyprop.__get__(self, obj, cls)
+
+        val = stashed(obj.stash, [self.name], 
+                      lambda: (np.asarray(self.func(obj)),))[0]
+        if val.ndim == 0:
+            val = val[()]
+        obj.__dict__[self.name] = val
+        return val
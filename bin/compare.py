@@ -1,19 +1,52 @@
 
 # general
 import numpy as np
+import sys
 
 # specific
 from fractions import Fraction
-from numpy.fft import fftn, ifftn, fft2, ifft2
-from scipy.misc import imresize
+from tempfile import TemporaryFile
 
 # other spims
-from utility import pad_to_size_of, overlaps
+from utility import (overlaps, LRUCache, integral, window_sums, 
+                     window_hashes, pack_rgb)
 from ims import Source, Pattern
+from fourier import plan
+from tracing import stage
 
 GEN_THRESH = .935
 SMALL_THRESH = .999
 
+# conjugated pattern spectra, keyed by padded shape
+SPECTRUM_BYTES = 256 * 2**20
+SPECTRUM_CACHE = LRUCache(SPECTRUM_BYTES)
+
+# windows with a relative variance below this are flat to within rounding
+FLAT = 1e-10
+
+# working memory allowed for one batched (volley) correlation
+VOLLEY_BYTES = 256 * 2**20
+
+# only look for pixel-exact occurrences of textured Patterns
+EXACT = False
+
+# memory allowed for one comparison, past which nccsat goes over the
+# Source in tiles; None for no limit
+MAX_MEMORY = None
+
+# rough bytes nccsat holds at once per padded Source pixel (spectra,
+# integral images and temporaries), and the arrows (masks, integral 
+# images, hashes) per Source pixel
+NCC_BYTES = 80
+ARROW_BYTES = 48
+EXACT_BYTES = 80
+
+# bytes per pixel of a decoded image (greyscale float32 and RGB)
+DECODED_BYTES = 7
+
+# Sources already warned about being too big to decode within MAX_MEMORY
+_warned = set()
+
 def choose_weapon(p):
     """Entry method into the world of comparison!
 
@@ -30,10 +63,12 @@ def choose_weapon(p):
     """
     if p.warr.size == 3:
         return single_arrow
-    elif p.arr.std() < 0.0001:
+    elif p.stdev < 0.0001:
         return barrage_of_arrows
+    elif EXACT:
+        return exact_arrows
     else:
-        return nccfft
+        return nccsat
 
 def single_arrow(s, p, fact=1):
     """Used for single pixel Pattern images.
@@ -56,16 +91,23 @@ def single_arrow(s, p, fact=1):
     out3 : float
        Mean of the confidence matrix.
     """
-    
-    notNorm = np.zeros(s.warr.shape)
-    notNorm[s.warr == p.warr[0]] = 1
-    nn = notNorm.mean(axis=2)
-    
+    def core(w):
+        return (w.warr == p.warr[0]).mean(axis=2)
+
+    if tiled(s, ARROW_BYTES):
+        nn, mean, std = in_tiles(s, p, core, ARROW_BYTES)
+        return nn, SMALL_THRESH, mean
+
+    nn = core(s)
     return nn, SMALL_THRESH, nn.mean()
 
 def barrage_of_arrows(s, p, fact=1):
     """Used for single, solid color Pattern images.
 
+    Marks the Source pixels of the Pattern's color once, then counts the
+    marked pixels of every Pattern sized window at once from an integral
+    image of the marks. Windows that are all marked are matches.
+
     ----------
     s, p : Image
        Pattern and Source images for comparison.
@@ -86,28 +128,75 @@ def barrage_of_arrows(s, p, fact=1):
     """
 
     c = p.warr[0,0]
+    if not (p.warr == c).all():
+        # flat in greyscale but not in color, so compare the whole thing
+        return exact_arrows(s, p, fact)
+
+    h, w = p.arr.shape
+    def core(win):
+        marks = (win.warr == c).all(axis=2)
+        return window_sums(integral(marks), (h, w)) == h * w
+
+    if tiled(s, ARROW_BYTES):
+        nn, mean, std = in_tiles(s, p, core, ARROW_BYTES, s.arr.shape)
+        return nn, SMALL_THRESH, mean
+
     nn = np.zeros(s.arr.shape)
-    nn_temp = np.zeros(s.warr.shape)
-    nn_temp[s.warr == c] = 1
-    nn_temp = nn_temp.mean(axis=2)
-    xs, y = np.where(nn_temp == 1)
+    nn[:nn.shape[0]-h+1, :nn.shape[1]-w+1] = core(s)
+    return nn, SMALL_THRESH, nn.mean()
+
+def exact_arrows(s, p, fact=1):
+    """Used for Patterns that occur in the Source pixel for pixel.
 
-    for i,xi in enumerate(xs):
+    Hashes every Pattern sized window of the Source with a 2d rolling
+    (Rabin-Karp) hash of the packed RGB values, in time linear in the
+    size of the Source whatever the size of the Pattern. Windows whose
+    hash matches the Pattern's are then checked pixel by pixel, so there
+    are no false positives.
+
+    ----------
+    s, p : Image
+       Pattern and Source images for comparison.
+       
+    fact : int, optional
+       Factor by which both Source and Pattern are
+       scaled down.
 
-        if (xi+p.warr.shape[0] <= s.warr.shape[0]
-            and y[i]+p.warr.shape[1] <= s.warr.shape[1]):                
-            con = (p.warr == s.warr[xi:xi+p.warr.shape[0],
-                                    y[i]:y[i]+p.warr.shape[1]])
-            if con.all():
-                nn[xi,y[i]] = 1
+    ----------
+    out1 : ndarray[float]
+       Confidence matrix for matches, 1 where the Pattern occurs.
 
+    out2 : float
+       Threshold for deciding if a match has been found.
+
+    out3 : float
+       Mean of the confidence matrix.
+    """
+    h, w = p.arr.shape
+    target = window_hashes(pack_rgb(p.warr), (h, w))[0,0]
+    def core(win):
+        hashes = window_hashes(pack_rgb(win.warr), (h, w))
+        nn = np.zeros(hashes.shape)
+        for yi, xi in zip(*np.where(hashes == target)):
+            if (win.warr[yi:yi+h, xi:xi+w] == p.warr).all():
+                nn[yi, xi] = 1
+        return nn
+
+    if tiled(s, EXACT_BYTES):
+        nn, mean, std = in_tiles(s, p, core, EXACT_BYTES)
+        return nn, SMALL_THRESH, mean
+
+    nn = core(s)
     return nn, SMALL_THRESH, nn.mean()
 
-def nccfft(s, p, fact=1):
+def nccsat(s, p, fact=1):
     """Used for all Patterns that do not fall other categories.
 
-    Cross correlates normalized Source and Pattern images while
-    taking advantage of FFTs for the convolution step. 
+    Cross correlates normalized Source and Pattern images. Only the 
+    numerator needs a correlation (and so FFTs); the window sums of the
+    Source and of its square come out of the Source's integral images.
+    Windows that are flat to within rounding get a zero, so the
+    confidences stay within [-1, 1].
     
     ----------
     s, p : Image
@@ -127,81 +216,323 @@ def nccfft(s, p, fact=1):
     out3 : float
        Mean of the confidence matrix.
     """
-    
-    # subtract mean from Pattern
-    pmm = p.arr - p.arr.mean()
-    pstd = p.arr.std()
-    n = p.arr.size
-    
-    # make matrix of ones the same size as pattern
-    u = np.ones(p.arr.shape)
+    if tiled(s):
+        return ncctiles(s, p, fact)
+
+    full = ncc_core(s, p)
+    with stage('post', shape=full.shape):
+        pmean = full.mean()
+        return full, nccfft_thresh(pmean, full.std(), fact), pmean
+
+def ncc_core(s, p):
+    """Confidence matrix of nccsat, without the threshold."""
+    pstd = p.stdev
+    valid = (s.arr.shape[0] - p.arr.shape[0] + 1,
+             s.arr.shape[1] - p.arr.shape[1] + 1)
+
+    pl = plan(s.arr.shape)
+    cfppad = SPECTRUM_CACHE.get((p.key, pl.key),
+                                lambda: pattern_spectrum(pl, p))
+    ffts = s.fft
+    with stage('inverse_fft', shape=pl.shape):
+        top = pl.irfft(cfppad * ffts, valid)
+
+    bottom = np.asarray(pstd * window_norms(s, p.arr.shape), pl.real)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        full = top / bottom
+    full[bottom == 0] = 0
+    np.clip(full, -1, 1, out=full)
+    return full
+
+def tiled(s, per=NCC_BYTES):
+    """Whether a comparison holding per bytes for every (padded) pixel
+    of s at once would go over MAX_MEMORY."""
+    if MAX_MEMORY is None:
+        return False
+    pl = plan(s.shape)
+    return pl.shape[0] * pl.shape[1] * per > MAX_MEMORY
+
+def ncctiles(s, p, fact=1):
+    """nccsat for Sources too big to do in one go.
+
+    Overlap-save: the confidence matrix is worked out tile by tile by
+    ncc_core (see in_tiles). Matches straddling tile borders are found
+    whole, and overlapping ones are thrown out later by overlaps as 
+    usual.
 
-    # pad matrices (necessary for convolution)
-    upad = pad_to_size_of(u, s.arr)
-    pmmpad = pad_to_size_of(pmm, s.arr)
+    ----------
+    s, p : Image
+       Pattern and Source images for comparison.
+       
+    fact : int, optional
+       Factor by which both Source and Pattern are scaled down.
 
-    # compute neccessary ffts
-    fftppad = fftn(pmmpad)
-    ffts = s.fft
-    fftss = s.fft2
-    fftu = fftn(upad)
+    ----------
+    out1 : ndarray[float]
+       Confidence matrix for matches (memory mapped).
 
-    # compute conjugates
-    cfppad = np.conj(fftppad)
-    cfu = np.conj(fftu)
+    out2 : float
+       Threshold for deciding if a match has been found.
 
-    # do multiplications and ifft's
-    top = ifftn(cfppad * ffts)
-    bot1 = n * ifftn(cfu * fftss)
-    bot2 = ifftn(cfu * ffts) ** 2
+    out3 : float
+       Mean of the confidence matrix.
+    """
+    full, pmean, pmstd = in_tiles(s, p, lambda w: ncc_core(w, p), 
+                                  NCC_BYTES)
+    return full, nccfft_thresh(pmean, pmstd, fact), pmean
+
+def in_tiles(s, p, core, per, shape=None):
+    """Confidence matrix of a comparison, worked out tile by tile.
+
+    The matrix is cut into square tiles, and each is worked out by core
+    from the window of the Source it needs, which is the tile grown by
+    the Pattern's size less one. The tiles share no outputs, so nothing
+    has to be stitched back together beyond copying them into place. 
+    Only one window's worth of the comparison (per bytes a pixel) is 
+    held at a time, within MAX_MEMORY, and the matrix goes to a 
+    temporary memory mapped file. Its mean and standard deviation are 
+    added up tile by tile.
+
+    The Source itself is decoded whole (PIL has no way of decoding part
+    of an image), which is warned about when that alone goes over
+    MAX_MEMORY.
 
-    # finish it off!
-    bottom = pstd * np.sqrt(bot1 - bot2)
-    full = top / bottom
+    ----------
+    s, p : Image
+       Pattern and Source images for comparison.
 
-    return nccfft_post(full, fact, p)
+    core : function
+       Confidences of every position of the Pattern in a Source (window)
+       that it fits in at.
 
-def nccfft_post(full, fact, p):
-    """Post proccessing on the results from nccfft. 
+    per : int
+       Rough bytes core holds per pixel of its window.
 
-    nccfft is so powerful that it needs a whole nother function to
-    determine the appropriate threshold, crop out meaningless values, 
-    and calculate its mean. 
+    shape : tuple[int], optional
+       Shape of the matrix, if bigger than the positions the Pattern 
+       fits in at (those of the Source, say); the rest of it is zero.
+
+    ----------
+    out1 : ndarray[float]
+       Confidence matrix (memory mapped).
+
+    out2, out3 : float
+       Mean and standard deviation of the confidence matrix.
+    """
+    ph, pw = p.arr.shape
+    vh = s.shape[0] - ph + 1
+    vw = s.shape[1] - pw + 1
+    if shape is None:
+        shape = (vh, vw)
+
+    if (s.shape[0] * s.shape[1] * DECODED_BYTES > MAX_MEMORY 
+        and s.path not in _warned):
+        _warned.add(s.path)
+        sys.stderr.write('Warning: ' + s.name + ' alone takes more than '
+                         'the memory allowed once decoded\n')
+
+    # biggest tile whose window fits in the budget, padding and all;
+    # budgets too small for the Pattern get tiles as big as it anyway
+    side = int(np.sqrt(MAX_MEMORY / float(per)) / 1.25)
+    side = max(side - max(ph, pw) + 1, max(ph, pw))
+
+    full = np.memmap(TemporaryFile(), plan(s.shape).real, 'w+', 
+                     shape=shape)
+    total = 0.
+    total2 = 0.
+    for y in range(0, vh, side):
+        for x in range(0, vw, side):
+            window = Source.peerWindow(s, (x, min(x + side, vw) + pw - 1, 
+                                           y, min(y + side, vh) + ph - 1))
+            tile = core(window)
+            full[y:y+tile.shape[0], x:x+tile.shape[1]] = tile
+            total += tile.sum(dtype=np.float64)
+            total2 += np.square(tile, dtype=np.float64).sum()
+            del window, tile
+
+    n = float(shape[0] * shape[1])
+    mean = total / n
+    return full, mean, np.sqrt(max(total2 / n - mean ** 2, 0))
+
+def window_norms(s, shape):
+    """Root of n*sum(w**2) - sum(w)**2 for every window w of the Source.
+
+    ----------
+    s : Source
+       Source with integral images ii and ii2 of arr and arr**2.
+
+    shape : tuple[int]
+       Shape of the windows, n being its size.
+
+    ----------
+    out : ndarray[float]
+       One entry per valid window position, zero for windows that are
+       flat to within rounding.
+    """
+    n = shape[0] * shape[1]
+    ii, ii2 = s.ii, s.ii2
+    with stage('norms', shape=shape):
+        s1 = window_sums(ii, shape)
+        s2 = window_sums(ii2, shape)
+        var = n * s2 - s1 ** 2
+        var[var <= FLAT * n * s2] = 0
+        return np.sqrt(var)
+
+def pattern_spectrum(pl, p):
+    """Conjugated spectrum of the padded, mean subtracted Pattern.
+
+    ----------
+    pl : Plan
+       Plan of the Source, giving the shape to pad to.
+
+    p : Pattern
+       Pattern to transform.
+
+    ----------
+    out : ndarray[complex]
+       Conjugated real FFT (half spectrum) of the padded Pattern.
+    """
+    # subtract mean from Pattern; named, as volleys have no one Pattern
+    with stage('pattern_fft', shape=pl.shape, pattern=p.name):
+        pmm = p.arr - p.arr.mean()
+        return np.conj(pl.rfft(pmm))
+
+def volley_size(s):
+    """Number of Patterns ncc_volley may take at once against s.
+
+    Each Pattern in a volley costs roughly a padded complex product, its
+    real inverse and a source sized confidence layer plus mask, all of
+    them half the size in single precision.
+    """
+    pl = plan(s.arr.shape)
+    per = pl.shape[0] * pl.shape[1] * 25 * np.dtype(pl.real).itemsize // 8
+    return max(1, VOLLEY_BYTES // per)
+
+def ncc_volley(s, ps, fact=1):
+    """Batched nccsat for many Patterns against one Source.
+
+    Stacks the (cached) spectra of all the Patterns, multiplies them with
+    the Source spectrum in one broadcast and inverts the whole stack in a
+    single call. The window norms of the Source only depend on the
+    Pattern shape, so they are computed once per distinct shape.
+
+    ----------
+    s : Image
+       Source image for comparison.
+
+    ps : list[Image]
+       Pattern images for comparison, all of which nccsat would handle.
+
+    fact : int, optional
+       Factor by which both Source and Patterns are scaled down.
+
+    ----------
+    out1 : ndarray[float]
+       Confidence cube, one Source sized layer per Pattern. Entries 
+       outside a Pattern's valid region are -inf.
+
+    out2 : ndarray[float]
+       Threshold for each layer.
+
+    out3 : ndarray[float]
+       Mean of each layer's valid region.
+    """
+    pl = plan(s.arr.shape)
+    shape = s.arr.shape
+    cfps = np.array([SPECTRUM_CACHE.get((p.key, pl.key),
+                                        lambda: pattern_spectrum(pl, p))
+                     for p in ps])
+
+    # numerators for all patterns in one go
+    ffts = s.fft
+    with stage('inverse_fft', shape=pl.shape, volley=len(ps)):
+        full = pl.irfft(cfps * ffts, shape)
+    del cfps
+
+    # denominators, once per pattern shape
+    pstd = np.array([p.stdev for p in ps])
+    shapes = {}
+    for k, p in enumerate(ps):
+        shapes.setdefault(p.arr.shape, []).append(k)
+    for sh, ks in shapes.items():
+        ks = np.array(ks)
+        root = window_norms(s, sh)
+        vh, vw = root.shape
+        with np.errstate(divide='ignore', invalid='ignore'):
+            full[ks, :vh, :vw] /= pstd[ks, None, None] * root
+        zY, zX = np.nonzero(root == 0)
+        full[ks[:, None], zY, zX] = 0
+    np.clip(full, -1, 1, out=full)
+
+    with stage('post', shape=full.shape):
+        return ncc_post_volley(full, fact, ps)
+
+def ncc_post_volley(full, fact, ps):
+    """Thresholds and means of a volley.
+
+    Same as nccsat works out for a single Pattern on every layer, 
+    worked out for the whole cube at once.
 
     ----------
     full : ndarray[float]
-       The full confidence matrix from nccfft.
+       Stack of full confidence matrices from ncc_volley.
        
     fact : int
-       The scale factor applied to both Source and Pattern.
+       The scale factor applied to both Source and Patterns.
 
-    p : Pattern
-       The pattern image used in the comparison.
+    ps : list[Pattern]
+       The pattern images, one per layer.
 
     ----------
     out1 : ndarray[float]
-       Cropped confidence matrix for matches.
+       The stack with everything outside of each valid region set
+       to -inf.
 
-    out2 : float
-       Threshold for deciding if a match has been found.
-
-    out3 : float
-       Mean of the confidence matrix.
+    out2 : ndarray[float]
+       Threshold for each layer.
 
+    out3 : ndarray[float]
+       Mean of each layer's valid region.
     """
-    probMatrix = full.real[:-p.arr.shape[0]+1,:-p.arr.shape[1]+1]
-    pmstd = probMatrix.std()
-    pmean = probMatrix.mean()
-    if pmstd < .1:
-        if fact > 1:
-            thresh = min(pmean + .60, .70)
-        else:
-            thresh = .95
-    else:
-        if fact > 1:
-            thresh = min(pmean + 5.0  * pmstd, .69)
-        else:
-            thresh = min(pmean + 5.5  * pmstd, .984)
+    hs = np.array([p.arr.shape[0] for p in ps])
+    ws = np.array([p.arr.shape[1] for p in ps])
+    H, W = full.shape[1:]
+    valid = ((np.arange(H)[None, :, None] <= (H - hs)[:, None, None])
+             & (np.arange(W)[None, None, :] <= (W - ws)[:, None, None]))
+    count = (H - hs + 1) * (W - ws + 1)
+
+    full[~valid] = 0
+    pmean = full.sum(axis=(1, 2)) / count
+    dev = full - pmean[:, None, None]
+    dev[~valid] = 0
+    pmstd = np.sqrt((dev ** 2).sum(axis=(1, 2)) / count)
+    del dev
+    full[~valid] = -np.inf
+
+    return full, nccfft_thresh(pmean, pmstd, fact), pmean
+
+def nccfft_thresh(pmean, pmstd, fact):
+    """Threshold for nccsat confidence matrices.
 
-    return probMatrix, thresh, pmean
+    Works on single values as well as arrays of them.
 
+    ----------
+    pmean, pmstd : float or ndarray[float]
+       Mean and standard deviation of the confidence matrix.
+
+    fact : int
+       The scale factor applied to both Source and Pattern.
+
+    ----------
+    out : float or ndarray[float]
+       Threshold for deciding if a match has been found.
+    """
+    if fact > 1:
+        thresh = np.where(pmstd < .1, np.minimum(pmean + .60, .70),
+                          np.minimum(pmean + 5.0  * pmstd, .69))
+    else:
+        thresh = np.where(pmstd < .1, .95,
+                          np.minimum(pmean + 5.5  * pmstd, .984))
+    if thresh.ndim == 0:
+        return float(thresh)
+    return thresh
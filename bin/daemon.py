@@ -0,0 +1,182 @@
+# general
+import sys, os, stat, signal
+
+# specific
+from shutil import rmtree
+from tempfile import mkdtemp
+from SocketServer import UnixStreamServer, StreamRequestHandler
+
+# other spims
+from run import parse_opts, pop_flag, configure, get_input_list
+from match import match_source
+from compare import choose_weapon
+from ims import Pattern, Source
+
+# run options that make no sense for one source at a time
+UNSUPPORTED = ['jobs', 'prefetch', 'trace']
+
+def preload(patterns):
+    """Load the patterns, with everything worked out from them alone.
+
+    ----------
+    patterns : str
+       Pattern file or directory.
+
+    ----------
+    out : list[Pattern]
+       The patterns, decoded and with their statistics computed.
+    """
+    ps = [Pattern(pi) for pi in get_input_list(patterns)]
+    for p in ps:
+        p.arr, p.warr, p.stdev, p.mean
+        choose_weapon(p)
+    return ps
+
+def read_request(req, inp, tmp):
+    """Source for a request line.
+
+    A request is either the path of a source image, or 'bytes <n>'
+    (optionally followed by a name for the image) with the n bytes of
+    an image file right after the line. Those are written out to tmp.
+
+    ----------
+    req : str
+       The request line, stripped.
+
+    inp : file
+       Where the request came from, to read image bytes off.
+
+    tmp : str
+       Directory to put images sent as bytes in.
+
+    ----------
+    out1 : Source
+       The source to match.
+
+    out2 : str
+       Temporary file to remove once done, or None.
+    """
+    words = req.split(None, 2)
+    if words[0] != 'bytes':
+        return Source(req), None
+
+    try:
+        n = int(words[1])
+    except (IndexError, ValueError):
+        sys.stderr.write('IOError: Malformed request\n')
+        sys.exit(1)
+    data = inp.read(n)
+    name = os.path.basename(words[2]) if len(words) > 2 else 'bytes'
+    path = os.path.join(tmp, name)
+    with open(path, 'wb') as fp:
+        fp.write(data)
+    return Source(path), path
+
+def serve(ps, inp, out, tmp, fmt='text', scaling=False, pyramid=False,
+          quota=None):
+    """Answer requests until the end of the input.
+
+    Each answer is the lines run.main would print for the source,
+    followed by an empty line. A request that fails (a bad image, say)
+    gets just the empty line, and the error goes to standard error as
+    usual.
+
+    ----------
+    ps : list[Pattern]
+       Preloaded patterns.
+
+    inp, out : file
+       Where requests come from and answers go.
+
+    tmp : str
+       Directory for images sent as bytes.
+
+    fmt : str, optional
+       'text' or 'jsonl', as for run.main.
+
+    scaling, pyramid : Boolean, optional
+       As for run.main.
+
+    quota : int, optional
+       if given, only the quota strongest matches of each pattern in
+       each source are answered with.
+    """
+    for line in iter(inp.readline, ''):
+        req = line.strip()
+        if req == '':
+            continue
+        path = None
+        try:
+            si, path = read_request(req, inp, tmp)
+            for ms, t in match_source(si, ps, scaling=scaling,
+                                      pyramid=pyramid, limit=quota):
+                for m in ms:
+                    out.write(m.toJSON(t) if fmt == 'jsonl' else str(m))
+        except SystemExit:
+            # the error has been written out already
+            pass
+        except Exception as e:
+            # nothing a request brings may take the daemon down with it
+            sys.stderr.write('%s: %s\n' % (e.__class__.__name__, e))
+        finally:
+            if path is not None and os.path.isfile(path):
+                os.remove(path)
+        out.write('\n')
+        out.flush()
+
+class Handler(StreamRequestHandler):
+    """Serves the requests of one connection to the socket."""
+
+    def handle(self):
+        serve(self.server.patterns, self.rfile, self.wfile,
+              self.server.tmp, **self.server.opts)
+
+def listen(path, ps, tmp, opts):
+    """Serve connections to a Unix socket at path, one at a time."""
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        os.remove(path)
+    server = UnixStreamServer(path, Handler)
+    server.patterns = ps
+    server.tmp = tmp
+    server.opts = opts
+    # so that being killed still cleans up
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(path)
+
+def main(opt):
+    """Command line entry of the daemon.
+
+    opt : list
+       options from command line: a pattern (-p or -pdir) and the
+       optional flags of spims, plus --socket <path> to listen on a Unix
+       socket rather than standard input
+    """
+    opt = list(opt)
+    path = pop_flag(opt, ['--socket'], str)
+    patterns, source, kwargs = parse_opts(opt, need_source=False)
+    for name in UNSUPPORTED:
+        if name in kwargs:
+            sys.stderr.write('IOError: --' + name + ' is not supported '
+                             'by the daemon\n')
+            sys.exit(1)
+
+    opts = dict((k, kwargs.pop(k)) 
+                for k in ['fmt', 'scaling', 'pyramid', 'quota']
+                if k in kwargs)
+    configure(**kwargs)
+    ps = preload(patterns)
+
+    tmp = mkdtemp(prefix='spims-')
+    try:
+        if path is None:
+            serve(ps, sys.stdin, sys.stdout, tmp, **opts)
+        else:
+            listen(path, ps, tmp, opts)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        rmtree(tmp)
@@ -0,0 +1,87 @@
+
+# general
+import numpy as np
+
+# specific
+from scipy.fftpack import next_fast_len
+
+try:
+    # FFTW keeps its plans around per shape when it is installed
+    import pyfftw
+    from pyfftw.interfaces.numpy_fft import rfftn, irfftn
+    pyfftw.interfaces.cache.enable()
+    pyfftw.interfaces.cache.set_keepalive_time(60)
+except ImportError:
+    from numpy.fft import rfftn, irfftn
+
+# real and complex types the arrays and spectra are kept in
+PRECISIONS = {'double': (np.float64, np.complex128),
+              'single': (np.float32, np.complex64)}
+PRECISION = 'double'
+
+def fast_shape(shape):
+    """Smallest 5-smooth shape at least as big as the given one.
+
+    Only the valid part of a correlation (pattern entirely inside the
+    source) is ever kept, and those offsets never wrap around once the
+    padded size covers the source, so this is also big enough for linear
+    correlation.
+
+    ----------
+    shape : tuple[int]
+       Shape of the Source image.
+
+    ----------
+    out : tuple[int]
+       Padded shape that the FFTs are fast on.
+    """
+    return tuple(next_fast_len(int(n)) for n in shape)
+
+class Plan:
+    """Real FFTs padded out to one fast shape.
+
+    ----------
+    shape : tuple[int]
+       Padded (fast) shape of the transforms.
+
+    precision : str
+       Key of PRECISIONS giving the types of the results.
+    """
+
+    def __init__(self, shape, precision='double'):
+        self.shape = shape
+        self.precision = precision
+        self.key = (shape, precision)
+        self.real, self.complex = PRECISIONS[precision]
+
+    def rfft(self, a):
+        """Half spectrum of a, zero padded to the plan's shape.
+
+        Stacks of images (leading axes) are transformed image by image.
+        """
+        a = np.asarray(a, self.real)
+        return np.asarray(rfftn(a, self.shape, axes=(-2, -1)), self.complex)
+
+    def irfft(self, f, crop):
+        """Inverse of a half spectrum (or a stack), cropped down to crop."""
+        full = irfftn(f, self.shape, axes=(-2, -1))
+        return np.asarray(full[..., :crop[0], :crop[1]], self.real)
+
+PLANS = {}
+
+def plan(shape):
+    """Get the (shared) Plan for images of the given shape.
+
+    ----------
+    shape : tuple[int]
+       Shape of the Source image.
+
+    ----------
+    out : Plan
+       Plan padding to the next fast shape covering shape, in the
+       current PRECISION.
+    """
+    key = (fast_shape(shape), PRECISION)
+    if key not in PLANS:
+        PLANS[key] = Plan(*key)
+    return PLANS[key]
@@ -1,68 +1,162 @@
-
-# specific
-from numpy.fft import fftn
-from scipy.misc import imresize
-from copy import deepcopy
+# general
+import numpy as np
 
 # other spims
-from utility import imread
+from utility import (imopen, imread, imdraft, integral, block_mean, lazyprop,
+                     LRUCache)
+from fourier import plan
+from cache import stash_dir, stashed, stashedprop
+from tracing import stage
+
+# bound on the bytes of resized images kept around for reuse
+SCALE_BYTES = 128 * 2**20
+SCALE_CACHE = LRUCache(SCALE_BYTES)
+
+class Im(object):
+    """Image read from a file, or derived from one.
+
+    Derived images (sizeDown, resize, peerWindow) hold views on the 
+    arrays of their parent where they can, and everything worked out 
+    from the arrays is computed on first use and then kept. Images read
+    from files also keep their arrays in the on-disk cache when it is on,
+    and are only decoded once their arrays are needed; until then their
+    shape comes from the file's header, and sizeDown decodes JPEGs 
+    straight at low res.
+    """
+
+    stash = None
 
-class Im:
     def __init__(self, path):
         self.path = path
+        self.key = path
         self.name = path.split('/')[-1]
-        self.arr, self.warr = imread(path)
-        self.stdev = self.arr.std()
-        self.mean = self.arr.mean()
+        self.stash = stash_dir(path)
+        fp, im = imopen(path)
+        with fp:
+            self.header = (im.size[1], im.size[0])
+
+    def decode(self):
+        with stage('decode', image=self.name) as st:
+            self.arr, self.warr = stashed(self.stash, ['arr', 'warr'],
+                                          lambda: imread(self.path))
+            st.set(shape=self.arr.shape)
+
+    @lazyprop
+    def arr(self):
+        self.decode()
+        return self.arr
+
+    @lazyprop
+    def warr(self):
+        self.decode()
+        return self.warr
+
+    @property
+    def shape(self):
+        """Shape of arr, without decoding the image if it isn't yet."""
+        if 'arr' in self.__dict__:
+            return self.arr.shape
+        return self.header
+
+    @stashedprop
+    def stdev(self):
+        return self.arr.std()
+
+    @stashedprop
+    def mean(self):
+        return self.arr.mean()
+
+    @property
+    def nbytes(self):
+        return self.arr.nbytes + self.warr.nbytes
 
     @staticmethod
-    def sizeDown(im, fact):
-        im2 = deepcopy(im)
-        im2.arr = im2.arr[::fact,::fact]
-        im2.warr = im2.warr[::fact,::fact,:]
-        im2.stdev = im2.arr.std()
-        im2.mean = im2.arr.mean()
+    def derive(im, key, arr, warr):
+        """New image of the same kind as im, holding the given arrays.
+
+        Nothing computed from the arrays of im is carried over.
+        """
+        im2 = object.__new__(im.__class__)
+        im2.path = im.path
+        im2.name = im.name
+        im2.key = key
+        im2.arr = arr
+        im2.warr = warr
         return im2
 
+    @staticmethod
+    def sizeDown(im, fact, average=False):
+        # a draft decode averages where striding samples, so the two
+        # are different images and must not share cache entries
+        if 'arr' not in im.__dict__:
+            with stage('decode', image=im.name, fact=fact) as st:
+                small = imdraft(im.path, fact)
+                st.set(draft=small is not None)
+            if small is not None:
+                return Im.derive(im, (im.key, 'draft', fact), *small)
+        # striding only sees every fact-th pixel, so fine detail that
+        # lands between them is lost; averaging keeps some of it, and
+        # is kept in SCALE_CACHE like resize is, for every Pattern to use
+        if average:
+            key = (im.key, 'mean', fact)
+            def make():
+                with stage('block_mean', shape=im.arr.shape, fact=fact):
+                    return Im.derive(im, key, block_mean(im.arr, fact),
+                                     block_mean(im.warr, fact))
+            return SCALE_CACHE.get(key, make)
+        return Im.derive(im, (im.key, 'down', fact), 
+                         im.arr[::fact,::fact], 
+                         im.warr[::fact,::fact,:])
+
     @staticmethod
     def resize(im, scaling):
-        im2 = deepcopy(im)
-        if im2.arr.shape == tuple(scaling):
-            return im2
-        im2.arr = imresize(im2.arr, scaling)
-        im2.warr = imresize(im2.warr, scaling)
-        im2.stdev = im2.arr.std()
-        im2.mean = im2.arr.mean()
-        return im2
+        """im resized to scaling.
+
+        Resized images are kept in SCALE_CACHE, along with whatever gets
+        worked out from them, so that each scaling of a Pattern is only
+        made once however many Sources it is compared with.
+        """
+        if im.arr.shape == tuple(scaling):
+            return im
+        key = (im.key, 'resize', tuple(scaling))
+        def make():
+            # scipy.misc is slow to import and only scaling needs it
+            from scipy.misc import imresize
+            with stage('resize', shape=tuple(scaling)):
+                return Im.derive(im, key, imresize(im.arr, scaling, mode='F'), 
+                                 imresize(im.warr, scaling))
+        return SCALE_CACHE.get(key, make)
 
 class Source(Im):
-    
-    def __init__(self, path):
-        Im.__init__(self,path)
-        self.fft = fftn(self.arr)
-        self.fft2 = fftn(self.arr ** 2)
+    """Image to be searched.
 
-    @staticmethod
-    def sizeDown(im, fact):
-        im2 = Im.sizeDown(im, fact)
-        im2.fft = fftn(im2.arr)
-        im2.fft2 = fftn(im2.arr ** 2)
-        return im2
+    fft is the real FFT (half spectrum) of arr, zero padded to the
+    fast shape of plan(arr.shape). ii and ii2 are the integral images
+    of arr and arr**2.
+    """
+
+    @stashedprop
+    def fft(self):
+        pl = plan(self.arr.shape)
+        with stage('source_fft', shape=pl.shape):
+            return pl.rfft(self.arr)
+
+    @stashedprop
+    def ii(self):
+        with stage('integral', shape=self.arr.shape):
+            return integral(self.arr)
+
+    @stashedprop
+    def ii2(self):
+        with stage('integral', shape=self.arr.shape):
+            return integral(np.square(self.arr, dtype=np.float64))
 
     @staticmethod
     def peerWindow(im, bounds):
-        im2 = deepcopy(im)
-        
-        im2.arr = im2.arr[bounds[2]:bounds[3],
-                          bounds[0]:bounds[1]]
-        im2.warr = im2.warr[bounds[2]:bounds[3],
-                            bounds[0]:bounds[1], :]
-        im2.fft = fftn(im2.arr)
-        im2.fft2 = fftn(im2.arr ** 2)
-        im2.stdev = im2.arr.std()
-        im2.mean = im2.arr.mean()
-
-        return im2
+        return Im.derive(im, (im.key, 'window', tuple(bounds)),
+                         im.arr[bounds[2]:bounds[3], bounds[0]:bounds[1]],
+                         im.warr[bounds[2]:bounds[3], 
+                                 bounds[0]:bounds[1], :])
 
 
 class Pattern(Im):
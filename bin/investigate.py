@@ -2,12 +2,17 @@
 # general
 import numpy as np
 
+# specific
+from time import time
+
 # other spims
-from compare import choose_weapon
+from compare import choose_weapon, ncc_volley, volley_size
 from ims import Source, Pattern
-from utility import overlaps, Match
+from utility import overlaps, Match, thread_map, above
+from tracing import stage, note
+import tracing
 
-def look_into_windows(si, pi, windows):
+def look_into_windows(si, pi, windows, limit=None):
     """Do full-res last ditch comparisons.
 
     Compare the pattern and source at the best scalings we could find at 
@@ -20,44 +25,164 @@ def look_into_windows(si, pi, windows):
     windows : dict
        Dictionary of scalings and windows that were found to be probable.
 
+    limit : int, optional
+       if given, only the limit strongest matches are kept
+
     ----------
     out : list[match]
        List of matches found by the comparisons. 
     """
-    goodOnes = []
-    for x in sorted(windows.keys(), key=lambda key: key[0]*key[1], 
-                    reverse=True):
-        
+    def look(x):
         # create window on source image
         swindow = Source.peerWindow(si, windows[x])
 
         pScaled = Pattern.resize(pi, x)
         
-        goodOnes += just_try_it_punk(swindow, pScaled)
+        return just_try_it_punk(swindow, pScaled, x, windows)
+
+    goodOnes = []
+    for found in thread_map(look, sorted(windows.keys(), 
+                                         key=lambda key: key[0]*key[1], 
+                                         reverse=True)):
+        goodOnes += found
         
     return [Match(m[4], m[3], m[1][0], m[1][1], m[0])
-            for m in overlaps(goodOnes)]
+            for m in strongest(overlaps(goodOnes), limit)]
 
-def one_shot_one_match(si, pi):
-    """Compare only one pair without any scaling or windows.
+def one_shot_one_match(si, pi, pyramid=False, limit=None):
+    """Compare only one pair without any scaling.
     
     We didn't do the low-res. We're shooting from the hip here, boys.
+    Unless we're asked to climb the pyramid, in which case only the 
+    windows the low-res pass finds get the full-res treatment.
     
     ----------
     si, pi : Image
        Source and Pattern to be compared.
 
+    pyramid : Boolean, optional
+       if True, look for candidate windows at low res first (see 
+       pyramid_windows) and only compare those at full res
+
+    limit : int, optional
+       if given, only the limit strongest matches are kept
+
     ----------
     out : list[match]
        List of matches found by the comparisons. 
     """
+    if pyramid:
+        from scale import pyramid_windows
+        with stage('pyramid'):
+            found = pyramid_windows(si, pi)
+        if found is not None:
+            windows, thresh = found
+            return climb_the_pyramid(si, pi, windows, thresh, limit)
+
     goodOnes = just_try_it_punk(si, pi, pi.arr.shape, 
-                                {pi.arr.shape:(0,0,0,0)})
+                                {pi.arr.shape:(0,0,0,0)}, limit)
     return [Match(m[4], m[3], m[1][0], m[1][1], m[0])
             for m in overlaps(goodOnes)]
 
+def climb_the_pyramid(si, pi, windows, thresh, limit=None):
+    """Full-res comparisons of an unscaled Pattern in a few windows.
+
+    The windows are too small for their own confidences to say what a
+    match is (nccfft_thresh wants those of the whole Source), so they 
+    are all held to the threshold pyramid_windows estimates.
+
+    ----------
+    si, pi : Image
+       Source and Pattern to be compared.
+
+    windows : list[tuple[int]]
+       (left,right,up,down) windows of the Source from pyramid_windows.
+
+    thresh : float
+       Full-res threshold from pyramid_windows.
+
+    limit : int, optional
+       if given, only the limit strongest matches are kept
 
-def just_try_it_punk(si, pi, x, windows):
+    ----------
+    out : list[match]
+       List of matches found by the comparisons. 
+    """
+    goodOnes = []
+    for w in windows:
+        swindow = Source.peerWindow(si, w)
+        goodOnes += just_try_it_punk(swindow, pi, pi.arr.shape, 
+                                     {pi.arr.shape:w}, thresh=thresh)
+    goodOnes.sort(key=lambda x: x[0], reverse=True)
+    return [Match(m[4], m[3], m[1][0], m[1][1], m[0])
+            for m in strongest(overlaps(goodOnes), limit)]
+
+def one_shot_many_matches(si, ps, limit=None):
+    """one_shot_one_match for a whole bank of nccsat Patterns at once.
+
+    The Patterns are correlated against the Source in volleys (see
+    ncc_volley) and the candidates of a whole volley are picked out of
+    the confidence cube in one vectorized pass. Those are shared, so
+    each Pattern is put down for an even share of their time (traced
+    as its 'correlate', marked with the size of the volley), and then
+    for the packing of its own candidates.
+
+    ----------
+    si : Image
+       Source to be compared.
+
+    ps : list[Image]
+       Patterns to be compared, all of which fit in si and would be 
+       handled by nccsat.
+
+    limit : int, optional
+       if given, only the limit strongest matches of each Pattern are
+       kept (see pack_the_best)
+
+    ----------
+    out : list[tuple[list[match], float]]
+       Matches found for each Pattern, and the seconds it was put down
+       for, in the order of ps.
+    """
+    found = []
+    step = volley_size(si)
+    for i in range(0, len(ps), step):
+        volley = ps[i:i+step]
+        t0 = time()
+        with stage('volley', shape=si.arr.shape, volley=len(volley)):
+            nn, thresh, mean = ncc_volley(si, volley)
+            mK, mY, mX = np.nonzero(nn > thresh[:, None, None])
+        share = (time() - t0) / len(volley)
+
+        # candidates come out ordered by layer
+        bounds = np.searchsorted(mK, np.arange(len(volley) + 1))
+        for k, pi in enumerate(volley):
+            t0 = time()
+            lo, hi = bounds[k], bounds[k+1]
+            tracing.pair(si.name, pi.name)
+            note('engine', engine='ncc_volley', volley=len(volley))
+            note('correlate', seconds=share, shape=si.arr.shape,
+                 volley=len(volley))
+            note('candidates', count=hi - lo)
+            if lo == hi:
+                found.append(([], share + time() - t0))
+                continue
+            with stage('pack'):
+                if limit is None:
+                    goodOnes = pack_the_goods(nn[k], si, pi, mX[lo:hi], 
+                                              mY[lo:hi], pi.arr.shape, 
+                                              (0,0,0,0))
+                else:
+                    goodOnes = pack_the_best(nn[k], si, pi, mX[lo:hi], 
+                                             mY[lo:hi], pi.arr.shape, 
+                                             (0,0,0,0), limit)
+            found.append(([Match(m[4], m[3], m[1][0], m[1][1], m[0])
+                           for m in overlaps(goodOnes)], 
+                          share + time() - t0))
+        tracing.pair(si.name, None)
+    return found
+
+def just_try_it_punk(si, pi, x, windows, limit=None, thresh=None):
     """Does the actual comparison. 
 
     Stores the goods for later.
@@ -73,17 +198,30 @@ def just_try_it_punk(si, pi, x, windows):
        Dictionary associating image scaling to a window,
        or (0,0,0,0) we are doing a one-off full comparison.
 
+    limit : int, optional
+       if given, only the limit strongest matches are packed, with the
+       overlapping ones already thrown out (see pack_the_best)
+
+    thresh : float, optional
+       Threshold to hold the confidences to instead of the one the 
+       comparison comes up with.
+
     ----------
     out : list[match]
        List of match info found by the comparison.     
     """
     method = choose_weapon(pi)
-    nn, thresh, mean = method(si, pi)
-    if nn.max() < 1.015:
-        mY, mX = np.where(nn > thresh)
-        return pack_the_goods(nn, si, pi, mX, mY, x, windows[x])
-    else: 
-        return []
+    note('engine', engine=method.__name__)
+    with stage('correlate', shape=si.arr.shape):
+        nn, ownThresh, mean = method(si, pi)
+    if thresh is None:
+        thresh = ownThresh
+    mY, mX = above(nn, thresh)
+    note('candidates', count=mX.size)
+    with stage('pack'):
+        if limit is None:
+            return pack_the_goods(nn, si, pi, mX, mY, x, windows[x])
+        return pack_the_best(nn, si, pi, mX, mY, x, windows[x], limit)
 
 
 def pack_the_goods(nn, s, p, mX, mY, scaling, window):
@@ -92,7 +230,8 @@ def pack_the_goods(nn, s, p, mX, mY, scaling, window):
     TODO: Make this sort of thing a class. 
 
     Packages data about matches into a format useful for the
-    overlaps function.
+    overlaps function. The confidences are gathered and sorted in
+    one go, strongest first (ties stay in the order given).
 
     ----------
     nn : ndarray[float]
@@ -116,11 +255,49 @@ def pack_the_goods(nn, s, p, mX, mY, scaling, window):
        List of packaged information about the potential matches without
        any overlapping matches.
     """
-    vals = []
-    for i,xi in enumerate(mX):
-        yi = mY[i]
-        c = nn[yi, xi]
-        vals.append([c, [xi+window[0], yi+window[2]], scaling, p, s])
-    if len(vals) > 0:
-        vals.sort(key=lambda x: x[0], reverse=True)
-    return vals
+    conf = nn[mY, mX]
+    order = np.argsort(-conf, kind='mergesort')
+    return [[c, [xi+window[0], yi+window[2]], scaling, p, s]
+            for c, xi, yi in zip(conf[order].tolist(), mX[order].tolist(),
+                                 mY[order].tolist())]
+
+def pack_the_best(nn, s, p, mX, mY, scaling, window, limit):
+    """The limit strongest goods that do not overlap.
+
+    Same as the first limit of overlaps(pack_the_goods(...)), without 
+    packing and sorting every candidate: only the strongest few are 
+    picked out (with a partial selection, ties and all), and more are 
+    only taken if overlaps throws too many of those out. Since overlaps
+    goes through goods strongest first, its picks out of the strongest
+    few are the ones it would have made out of all of them.
+
+    ----------
+    nn, s, p, mX, mY, scaling, window
+       As for pack_the_goods.
+
+    limit : int
+       Number of goods wanted.
+
+    ----------
+    out : list[...]
+       Up to limit packaged matches, strongest first, none overlapping.
+    """
+    conf = nn[mY, mX]
+    take = limit
+    while True:
+        if take < conf.size:
+            cut = -np.partition(-conf, take - 1)[take - 1]
+            pick = np.flatnonzero(conf >= cut)
+        else:
+            pick = np.arange(conf.size)
+        goodOnes = overlaps(pack_the_goods(nn, s, p, mX[pick], mY[pick],
+                                           scaling, window))
+        if len(goodOnes) >= limit or pick.size == conf.size:
+            return goodOnes[:limit]
+        take *= 4
+
+def strongest(goodOnes, limit=None):
+    """The limit strongest of goods (all of them if limit is None)."""
+    if limit is None:
+        return goodOnes
+    return sorted(goodOnes, key=lambda x: x[0], reverse=True)[:limit]
@@ -1,38 +1,318 @@
 
+# general
+import sys
+
 # specific
 from time import time
+from threading import Thread
+from Queue import Queue, Empty
 # other spims
-from scale import super_chunk_train_choo_choo
-from investigate import look_into_windows, one_shot_one_match
+from investigate import (look_into_windows, one_shot_one_match,
+                         one_shot_many_matches)
 from ims import Pattern, Source
+from compare import SPECTRUM_CACHE, choose_weapon, nccsat, tiled
+from tracing import stage
+import tracing
 
-def match_master_ten_thousand(s, p, scaling=False):
+def match_master_ten_thousand(s, p, scaling=False, jobs=1, pyramid=False,
+                              prefetch=0, quota=None):
     """Main matching engine.
     
     Loops over each pattern for each source image and runs subimage matching 
-    routines on them.
+    routines on them. A generator, so results can be used as soon as each
+    pair is done.
 
     s, p : list
        list of strings referencing source and pattern images to be converted
        into Source and Pattern objects as needed.
+
+    jobs : int, optional
+       number of worker processes to spread the (source, pattern) pairs
+       over. Matches come back in the same order either way.
+
+    pyramid : Boolean, optional
+       if True, unscaled comparisons look for candidate windows at low
+       res first and only compare those at full res
+
+    prefetch : int, optional
+       number of sources to load and prepare ahead, in the background,
+       while the current one is being matched (see fetch_ahead); 0 to
+       load each as its turn comes
+
+    quota : int, optional
+       if given, only this many matches are wanted of each pattern: 
+       every comparison keeps its quota strongest matches, the first ones
+       found (source by source) are reported, and a pattern is not 
+       compared with any more sources once it has them all. The run 
+       stops when every pattern has.
+
+    Yields a (matches, time) tuple for every pair compared, source by 
+    source and then pattern by pattern.
+    """
+    opts = {'scaling':scaling, 'pyramid':pyramid, 'limit':quota}
+    if jobs > 1 and len(s)*len(p) > 1:
+        from multiprocessing import Array
+        done = Array('b', len(p), lock=False)
+        pairs = match_in_pool(s, p, opts, jobs, done)
+    else:
+        done = [False] * len(p)
+        pairs = match_in_turn(s, p, opts, prefetch, done)
+
+    left = [quota] * len(p)
+    try:
+        for j, (ms, t) in pairs:
+            if quota is not None:
+                # workers may be ahead of the patterns that are done
+                if left[j] == 0:
+                    continue
+                ms = ms[:left[j]]
+                left[j] -= len(ms)
+                done[j] = left[j] == 0
+            yield ms, t
+            if quota is not None and all(done):
+                return
+    finally:
+        pairs.close()
+
+def match_in_turn(s, p, opts, prefetch, done):
+    """In process version of match_master_ten_thousand.
+
+    done : list[Boolean]
+       patterns not to compare with the sources to come, by index; 
+       looked at afresh for each source
+
+    Yields a (pattern index, (matches, time)) tuple for every pair 
+    compared.
     """
     p = [Pattern(pi) for pi in p]
-    rm = []
-    times = []
-    for si in s:
-        si = Source(si)
-        for pi in p:
-
-            t0 = time() # keep track of time for diagnostics
-
-            if (si.arr.shape[0] >= pi.arr.shape[0] 
-                and si.arr.shape[1] >= pi.arr.shape[1]):
-                if scaling:
-                    windows = super_chunk_train_choo_choo(si, pi)
-                    rm += look_into_windows(si, pi, windows)
-                else:
-                    rm += one_shot_one_match(si, pi)
-
-            times.append(time() - t0)
-            
-    return rm, times
+    ncc = any(choose_weapon(pi) is nccsat for pi in p)
+    for si in fetch_ahead(s, prefetch, 
+                          lambda si: prepare(si, ncc, **opts)):
+        live = [j for j in range(len(p)) if not done[j]]
+        for j, r in zip(live, match_source(si, [p[j] for j in live], 
+                                           **opts)):
+            yield j, r
+
+def fetch_ahead(s, depth, ready):
+    """Sources for the given paths, loaded ahead in a background thread.
+
+    The thread keeps up to depth Sources loaded and readied in a queue,
+    so that reading and decoding the next ones overlaps with matching
+    the current one while memory stays bounded. Errors in the thread
+    come out of here, where the Source they happened on would have.
+
+    s : list
+       paths of the source images.
+
+    depth : int
+       number of Sources to keep ready; 0 to load each in turn, here.
+
+    ready : function
+       gets a freshly made Source ready for matching.
+
+    Yields a Source for each path, in order.
+    """
+    if depth < 1:
+        for si in s:
+            yield Source(si)
+        return
+
+    queue = Queue(depth)
+    stop = []
+
+    def produce():
+        try:
+            for si in s:
+                if stop:
+                    return
+                si = Source(si)
+                # traced under its own name, not that of whatever the
+                # main thread is comparing meanwhile
+                tracing.pair(si.name, None)
+                ready(si)
+                queue.put((si, None))
+            queue.put((None, None))
+        except BaseException:
+            queue.put((None, sys.exc_info()))
+
+    worker = Thread(target=produce)
+    worker.daemon = True
+    worker.start()
+    try:
+        while True:
+            si, err = queue.get()
+            if err is not None:
+                raise err[0], err[1], err[2]
+            if si is None:
+                return
+            yield si
+    finally:
+        # let the thread see it should stop, even if it is stuck on
+        # a full queue
+        stop.append(True)
+        while worker.is_alive():
+            try:
+                queue.get(timeout=.1)
+            except Empty:
+                pass
+
+def prepare(si, ncc, scaling=False, pyramid=False, limit=None):
+    """Get a Source ready for match_source ahead of its turn.
+
+    For plain comparisons that means its arrays, and the spectrum and
+    integral images that nccsat (if any pattern goes to it) will want.
+    Scaled and pyramid comparisons decode what they need (at low res
+    where they can) themselves, as do tiled ones, so for those only the
+    file is read ahead, for the OS to have it at hand.
+
+    si : Source
+    ncc : Boolean
+       whether any of the patterns go to nccsat
+    """
+    if scaling or pyramid or tiled(si):
+        with open(si.path, 'rb') as fp:
+            while fp.read(2**20):
+                pass
+        return
+    si.arr, si.warr
+    if ncc:
+        si.fft, si.ii, si.ii2
+
+def match_source(si, ps, scaling=False, pyramid=False, limit=None):
+    """Run subimage matching of every pattern against one source.
+
+    Unscaled patterns that go to nccsat are matched together in volleys
+    (see one_shot_many_matches), everything else pair by pair, as is
+    everything on sources too big to be done without tiles.
+
+    si : Source
+    ps : list[Pattern]
+
+    scaling : Boolean, optional
+       if True, also look for scaled versions of the patterns
+
+    pyramid : Boolean, optional
+       if True, do unscaled comparisons coarse to fine (pair by pair)
+
+    limit : int, optional
+       if given, only the limit strongest matches of each pair are kept
+
+    Returns a (matches, time) tuple for each pattern, in the order of ps.
+    Patterns matched in a volley split the time of the shared 
+    correlation evenly, on top of the time of their own candidates (see
+    one_shot_many_matches).
+    """
+    results = [None] * len(ps)
+    volley = []
+    for j, pi in enumerate(ps):
+        if (not scaling and not pyramid and fits(si, pi) 
+            and not tiled(si) and choose_weapon(pi) is nccsat):
+            volley.append(j)
+            continue
+
+        t0 = time() # keep track of time for diagnostics
+        tracing.pair(si.name, pi.name)
+        results[j] = (match_pair(si, pi, scaling, pyramid, limit), 
+                      time() - t0)
+
+    if len(volley) > 0:
+        tracing.pair(si.name, None)
+        found = one_shot_many_matches(si, [ps[j] for j in volley], limit)
+        for j, r in zip(volley, found):
+            results[j] = r
+
+    tracing.pair(None, None)
+    return results
+
+def fits(si, pi):
+    """Whether the pattern fits inside the source."""
+    return (si.shape[0] >= pi.shape[0] 
+            and si.shape[1] >= pi.shape[1])
+
+def match_pair(si, pi, scaling=False, pyramid=False, limit=None):
+    """Run subimage matching on a single source and pattern.
+
+    si : Source
+    pi : Pattern
+
+    scaling : Boolean, optional
+       if True, also look for scaled versions of the pattern
+
+    pyramid : Boolean, optional
+       if True, do unscaled comparisons coarse to fine
+
+    limit : int, optional
+       if given, only the limit strongest matches are kept
+    """
+    if fits(si, pi):
+        if scaling:
+            from scale import super_chunk_train_choo_choo
+            with stage('scale_search'):
+                windows = super_chunk_train_choo_choo(si, pi)
+            with stage('full_res', windows=len(windows)):
+                return look_into_windows(si, pi, windows, limit)
+        else:
+            return one_shot_one_match(si, pi, pyramid, limit)
+    return []
+
+def match_in_pool(s, p, opts, jobs, done):
+    """Process-pool version of match_in_turn.
+
+    Work units are a source and a group of patterns, handed out in 
+    source-major order. With at least as many sources as jobs a group is
+    every pattern, otherwise the patterns are split into jobs groups so
+    that a single source still keeps every worker busy. done is shared
+    with the workers, which skip the patterns in it as they come to 
+    them.
+    """
+    if len(s) >= jobs:
+        size = len(p)
+    else:
+        size = max(1, -(-len(p) // jobs))
+    groups = [range(j, min(j + size, len(p))) for j in range(0, len(p), size)]
+
+    units = [(si, js, opts) for si in s for js in groups]
+    from multiprocessing import Pool
+    pool = Pool(jobs, pool_init, (p, done))
+    try:
+        for results, hits, misses, records in pool.imap(pool_work, units):
+            # fold the workers' cache counts and traces into ours for 
+            # diagnostics
+            SPECTRUM_CACHE.hits += hits
+            SPECTRUM_CACHE.misses += misses
+            tracing.RECORDS += records
+            for r in results:
+                yield r
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+# per worker state for match_in_pool
+_patterns = []
+_source = None
+_done = []
+
+def pool_init(p, done):
+    """Load every pattern once per worker process."""
+    global _patterns, _done
+    _patterns = [Pattern(pi) for pi in p]
+    _done = done
+
+def pool_work(unit):
+    """Match one (source path, pattern indices, options) work unit."""
+    global _source
+    si, js, opts = unit
+    js = [j for j in js if not _done[j]]
+    if len(js) == 0:
+        return [], 0, 0, tracing.drain()
+    if _source is None or _source.path != si:
+        _source = None
+        _source = Source(si)
+
+    hits, misses = SPECTRUM_CACHE.hits, SPECTRUM_CACHE.misses
+    results = match_source(_source, [_patterns[j] for j in js], **opts)
+    return (zip(js, results), SPECTRUM_CACHE.hits - hits, 
+            SPECTRUM_CACHE.misses - misses, tracing.drain())
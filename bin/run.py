@@ -1,14 +1,13 @@
 
 # general
-import numpy as np
-import sys, os
+import sys, os, json
 
 # specific
-from PIL import Image
 from time import time
 
-# other spims
-from match import match_master_ten_thousand
+# other spims (the rest, and numpy and scipy with them, are only imported
+# once the command line has been parsed and what it asks for is known)
+import tracing
 
 def get_input_list(s):
     """Make list of images depending on input.
@@ -21,7 +20,21 @@ def get_input_list(s):
     else:
         return [s]            
 
-def main(patterns, sources, printMatches=True, diag=False):
+FORMATS = ['text', 'jsonl']
+
+SIZES = {'K':2**10, 'M':2**20, 'G':2**30}
+
+def parse_size(text):
+    """Bytes in a size such as 1000000, 512M or 2G."""
+    text = text.strip().upper()
+    if text[-1:] in SIZES:
+        return int(float(text[:-1]) * SIZES[text[-1]])
+    return int(text)
+
+def main(patterns, sources, printMatches=True, diag=False, jobs=1,
+         cache_dir=None, fmt='text', pyramid=False, exact=False,
+         scaling=False, threads=1, precision='double', max_memory=None,
+         trace=None, prefetch=0, quota=None):
     """Main program function.
 
     Do subimage matching for given inputs and print (or not)
@@ -31,37 +44,158 @@ def main(patterns, sources, printMatches=True, diag=False):
        Represent input images to be compared
 
     printMatches : Boolean, optional
-       if True, print matches to stdout; else, return them
+       if True, print matches to stdout as each comparison finishes; 
+       else, return them
 
     diag : Boolean, optional
        if True, print or return diagnostic information; else
        do nothing of the sort
+
+    jobs : int, optional
+       number of worker processes to do the comparisons with
+
+    cache_dir : str, optional
+       directory to keep decoded images and their spectra in between
+       runs; if None nothing is kept
+
+    fmt : str, optional
+       'text' prints the usual match lines, 'jsonl' prints one JSON
+       object per match (with the time of its comparison) and the
+       diagnostics as a final JSON object
+
+    pyramid : Boolean, optional
+       if True, find candidate windows at low res first and only compare
+       those at full res
+
+    exact : Boolean, optional
+       if True, only report pixel-exact occurrences of textured patterns
+
+    scaling : Boolean, optional
+       if True, also look for the patterns scaled up (keeping their
+       aspect ratio)
+
+    threads : int, optional
+       number of threads to compare the scalings of a pattern with
+
+    precision : str, optional
+       'double' keeps the spectra and confidences in float64/complex128,
+       'single' in float32/complex64 (half the memory)
+
+    max_memory : int, optional
+       bytes a single comparison may use; bigger sources are compared
+       tile by tile
+
+    trace : str, optional
+       file to write the time taken by every stage of every comparison
+       to, as a CSV summary if it ends in .csv and as JSON otherwise
+
+    prefetch : int, optional
+       number of sources to load ahead in the background while the
+       current one is matched
+
+    quota : int, optional
+       if given, stop looking for a pattern once this many matches of it
+       have been found (its strongest in each source, sources in order)
     """
     t0 = time()
+    import numpy as np
+    from match import match_master_ten_thousand
+    from compare import SPECTRUM_CACHE
+
+    configure(cache_dir, exact, threads, precision, max_memory)
+    tracing.ON = trace is not None
+    tracing.drain()
+    hits, misses = SPECTRUM_CACHE.hits, SPECTRUM_CACHE.misses
 
     patterns = get_input_list(patterns)
     sources = get_input_list(sources)
 
     # comparisons
-    matches, diagd = match_master_ten_thousand(sources, patterns)
+    matches = []
+    diagd = []
+    for ms, t in match_master_ten_thousand(sources, patterns, 
+                                           scaling=scaling, jobs=jobs,
+                                           pyramid=pyramid, 
+                                           prefetch=prefetch, quota=quota):
+        diagd.append(t)
+        if printMatches == True:
+            for m in ms:
+                if fmt == 'jsonl':
+                    sys.stdout.write(m.toJSON(t))
+                else:
+                    sys.stdout.write(str(m))
+            if len(ms) > 0:
+                sys.stdout.flush()
+        else:
+            matches += ms
+    hits = SPECTRUM_CACHE.hits - hits
+    misses = SPECTRUM_CACHE.misses - misses
+    if trace is not None:
+        tracing.export(trace, tracing.drain())
 
     if printMatches == True:
-        for m in matches:
-            sys.stdout.write(str(m))
-
-        if diag:
+        if diag and fmt == 'jsonl':
+            print json.dumps({"total_time":time() - t0,
+                              "comp_num":len(diagd),
+                              "avg_time":np.mean(diagd),
+                              "std_time":np.std(diagd),
+                              "cache_hits":hits,
+                              "cache_misses":misses}, sort_keys=True)
+        elif diag:
             print '\nTotal time: ' + str(time() - t0)
             print ('Compared ' + str(len(diagd)) + ' images with an average \n'
                    'time of '+str(round(np.mean(diagd),3))+'s per comparison \n'
                    'and a std of '+str(round(np.std(diagd),3))+'s.')
+            print ('Pattern spectrum cache: ' + str(hits) + ' hits, '
+                   + str(misses) + ' misses.')
     else:
         diagd = {"total_time":str(time() - t0),
                 "comp_num":str(len(diagd)),
                 "avg_time":str(round(np.mean(diagd),3)),
-                "std_time":str(round(np.std(diagd),3))}
+                "std_time":str(round(np.std(diagd),3)),
+                "cache_hits":str(hits),
+                "cache_misses":str(misses)}
         return matches, diagd
 
-def parse_opts(opt):
+def configure(cache_dir=None, exact=False, threads=1, precision='double',
+              max_memory=None):
+    """Set the module wide settings of a run (see main)."""
+    import cache, compare, utility, fourier
+    cache.CACHE_DIR = cache_dir
+    compare.EXACT = exact
+    utility.THREADS = threads
+    fourier.PRECISION = precision
+    compare.MAX_MEMORY = max_memory
+
+def pop_flag(opt, names, cast=None):
+    """Pull an optional flag (and its value) out of the options.
+
+    opt : list
+       list of options from command line, the flag is removed in place
+
+    names : list[str]
+       accepted spellings of the flag
+
+    cast : function, optional
+       converts the value following the flag; if None the flag takes
+       no value and True is returned when it is present
+    """
+    for name in names:
+        if name in opt:
+            i = opt.index(name)
+            if cast is None:
+                del opt[i]
+                return True
+            try:
+                val = cast(opt[i+1])
+            except (IndexError, ValueError):
+                sys.stderr.write('IOError: Bad value for '+name+'\n')
+                sys.exit(1)
+            del opt[i:i+2]
+            return val
+    return None
+
+def parse_opts(opt, need_source=True):
     """Nasty options parser.
     
     Does nasty things to parse the options because we didn't think of what
@@ -69,13 +203,101 @@ def parse_opts(opt):
 
     opt : list
        list of options from command line
+
+    need_source : Boolean, optional
+       if False, only a pattern (file or directory) is expected, and the
+       source comes back as None
+
+    Returns the pattern, the source and a dict of keyword arguments for
+    main built from the optional flags.
     """
+    opt = list(opt)
+    kwargs = {}
+
+    jobs = pop_flag(opt, ['-j', '--jobs'], int)
+    if jobs is not None:
+        if jobs < 1:
+            sys.stderr.write('IOError: Expected a positive number of jobs\n')
+            sys.exit(1)
+        kwargs['jobs'] = jobs
+
+    threads = pop_flag(opt, ['-t', '--threads'], int)
+    if threads is not None:
+        if threads < 1:
+            sys.stderr.write('IOError: Expected a positive number of '
+                             'threads\n')
+            sys.exit(1)
+        kwargs['threads'] = threads
+
+    cache_dir = pop_flag(opt, ['--cache'], str)
+    if cache_dir is not None:
+        kwargs['cache_dir'] = cache_dir
+
+    fmt = pop_flag(opt, ['--format'], str)
+    if fmt is not None:
+        if fmt not in FORMATS:
+            sys.stderr.write('IOError: Expected format to be one of '
+                             + ', '.join(FORMATS) + '\n')
+            sys.exit(1)
+        kwargs['fmt'] = fmt
+
+    precision = pop_flag(opt, ['--precision'], str)
+    if precision is not None:
+        import fourier
+        if precision not in fourier.PRECISIONS:
+            sys.stderr.write('IOError: Expected precision to be one of '
+                             + ', '.join(sorted(fourier.PRECISIONS)) 
+                             + '\n')
+            sys.exit(1)
+        kwargs['precision'] = precision
+
+    max_memory = pop_flag(opt, ['--max-memory'], parse_size)
+    if max_memory is not None:
+        if max_memory < 1:
+            sys.stderr.write('IOError: Expected a positive memory size\n')
+            sys.exit(1)
+        kwargs['max_memory'] = max_memory
+
+    prefetch = pop_flag(opt, ['--prefetch'], int)
+    if prefetch is not None:
+        if prefetch < 0:
+            sys.stderr.write('IOError: Expected a number of sources to '
+                             'prefetch\n')
+            sys.exit(1)
+        kwargs['prefetch'] = prefetch
+
+    quota = pop_flag(opt, ['--top-k'], int)
+    if pop_flag(opt, ['--first-match']):
+        if quota is not None:
+            sys.stderr.write('IOError: Expected only one of --first-match '
+                             'and --top-k\n')
+            sys.exit(1)
+        quota = 1
+    if quota is not None:
+        if quota < 1:
+            sys.stderr.write('IOError: Expected a positive number of '
+                             'matches\n')
+            sys.exit(1)
+        kwargs['quota'] = quota
+
+    trace = pop_flag(opt, ['--trace'], str)
+    if trace is not None:
+        kwargs['trace'] = trace
+
+    if pop_flag(opt, ['--pyramid']):
+        kwargs['pyramid'] = True
+
+    if pop_flag(opt, ['--exact']):
+        kwargs['exact'] = True
+
+    if pop_flag(opt, ['--scaling']):
+        kwargs['scaling'] = True
         
-    if len(opt) != 4:
+    if len(opt) != (4 if need_source else 2):
         sys.stderr.write('IOError: Malformed input\n')
         sys.exit(1)
 
-    opt = [(opt[0],opt[1]),(opt[2],opt[3])]
+    opt = [(opt[0],opt[1]),(opt[2],opt[3])] if need_source else [opt]
     if opt[0][0] == '-p':
         if os.path.isfile(opt[0][1]):
             pattern = opt[0][1]
@@ -97,7 +319,9 @@ def parse_opts(opt):
     elif opt[0][0] != '-p' and opt[0][0] != '-pdir' and opt[0][0] != '--pdir':
         sys.stderr.write('IOError: Expected pattern image or directory')
         sys.exit(1)
-    if opt[1][0] == '-s':
+    if not need_source:
+        source = None
+    elif opt[1][0] == '-s':
         if os.path.isfile(opt[1][1]):
             source = opt[1][1]
         else: 
@@ -105,7 +329,7 @@ def parse_opts(opt):
             sys.exit(1)
     elif opt[1][0] == '-sdir' or opt[1][0] == '--sdir':
         if os.path.isdir(opt[1][1]):
-            spath = opt[0][1] + '/'
+            spath = opt[1][1] + '/'
             for x in os.listdir(spath):
                 if os.path.isdir(x):
                     sys.stderr.write('IOError: Source directory contains directories\n')
@@ -122,5 +346,5 @@ def parse_opts(opt):
         sys.stderr.write('IOError: Malformed input\n')
         sys.exit(1)
 
-    return pattern, source
+    return pattern, source, kwargs
 
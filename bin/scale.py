@@ -7,9 +7,22 @@ from fractions import Fraction
 
 # other spims
 from ims import Source, Pattern
-from compare import choose_weapon
-
-SLOP = 4.5
+from compare import choose_weapon, nccsat, nccfft_thresh
+from fourier import plan
+from utility import thread_map, integral, window_sums
+
+# scalings proposed by the Fourier-Mellin estimate, and number of the
+# best starting scalings climbed from
+MELLIN_K = 5
+# log-radius bins of the Fourier-Mellin profiles
+MELLIN_BINS = 256
+# ratio between the rungs of the ladder of scalings always tried as
+# well as the Fourier-Mellin proposals
+RUNG = 1.25
+
+# pyramid windows covering more than this much of the Source aren't
+# worth it over a plain full-res comparison
+PYRAMID_AREA = .25
 
 def possible_scales(s, p, fact):
     """Generate list of possible scalings.
@@ -41,8 +54,8 @@ def possible_scales(s, p, fact):
     currScaHigh = (p.arr.shape[0], p.arr.shape[1])
     currScaLow = (p.arr.shape[0]/fact, p.arr.shape[1]/fact)
 
-    sX = int(s.arr.shape[0])
-    sY = int(s.arr.shape[1])
+    sX = int(s.shape[0])
+    sY = int(s.shape[1])
 
     while(currScaHigh[0] <= sX and currScaHigh[1] <= sY):
         if currScaLow in scales.keys():
@@ -84,10 +97,9 @@ def res_factor(s, p):
 def super_chunk_train_choo_choo(s, p):
     """The main boss of all scaling-comparison-related activities.
 
-    Utilizes a sort of chunk search approach to finding potentially
-    scaled subimages. Though the set is not ordered, it does peak
-    near true scalings enabling us to search for those peaks using
-    an iterative deepening/chunk search-type logic. 
+    Finds potentially scaled subimages by climbing to the best low-res
+    scalings (see climb_scales). Though the set is not ordered, it does
+    peak near true scalings, so the climb need not try all of them.
 
     ----------
     s, p : Images
@@ -110,35 +122,8 @@ def super_chunk_train_choo_choo(s, p):
     
     allLowRes = scales.keys()
     allLowRes.sort(reverse=True)
-    n = len(scales) 
-    
-    step = max(n/100, 1)
-    scatu = allLowRes
-
-    while (step > 0 and len(scatu)/step > 0):
-        scatu = scatu[::step]
-
-        windows, strengths = train_cars(sd, pd, scatu, fact)
 
-        if len(strengths) == 0:
-            break; 
-        
-        best = max(strengths, key=lambda x: x[1])
-        nextBest = [x[0]*step for x in strengths if x[1] > best[1] - .02]
-        
-        scatu = []
-        for b in nextBest:
-            begin = b - step; end = b + step
-            if begin < 0:
-                begin = 0
-            if end > n:
-                end = n
-            scatu += allLowRes[begin:end]
-        step = step/2 
-        scatu = list(set(scatu))
-
-    
-    return real_windows(windows, scales)
+    return real_windows(climb_scales(sd, pd, allLowRes, fact), scales)
 
 def real_windows(wins, scals):
     """Convert from low-res windows to high-res.
@@ -161,57 +146,165 @@ def real_windows(wins, scals):
 
     return realWindows
     
-def train_cars(s, p, scatu, fact):
-    """Loop over and compare scalings given.
-    
-    Does the comparison at each level of scaling and records 
-    the max value and probable window of promising comparisons.
+def estimate_scales(s, p, k=MELLIN_K):
+    """Fourier-Mellin estimate of the scalings of a Pattern in a Source.
+
+    Scaling an image by a shrinks its spectrum by a, which along the
+    log of the radius of a log-polar spectrum is a shift by log(a). So
+    the log magnitude spectra of the Source and of the Pattern (padded to
+    the same size) are averaged over the angle into profiles along the
+    log-radius, and the shifts at which the Pattern's profile best lines
+    up with the Source's give the likely scalings, whatever the ratio of
+    their sizes.
 
     ----------
     s, p : Image
-       Images to be compared. 
+       The images to be compared.
+
+    k : int, optional
+       Number of scalings to propose.
 
-    scatu : list[tuple[int]]
-       List of scalings to try.
+    ----------
+    out : list[float]
+       Up to k scale factors (at least 1) of the Pattern, best first.
+    """
+    pl = plan(s.arr.shape)
+    fy = np.fft.fftfreq(pl.shape[0])[:, None]
+    fx = np.fft.rfftfreq(pl.shape[1])[None, :]
+    rho = np.sqrt(fy ** 2 + fx ** 2).ravel()
+
+    # log-radius bins from the lowest frequency the Source has to Nyquist
+    low = np.log(1.0 / min(pl.shape))
+    step = (np.log(.5) - low) / MELLIN_BINS
+    bins = np.floor((np.log(np.maximum(rho, 1e-12)) - low) / step)
+    inside = (bins >= 0) & (bins < MELLIN_BINS)
+    bins = bins[inside].astype(int)
+    counts = np.maximum(np.bincount(bins, minlength=MELLIN_BINS), 1)
+    ramp = np.arange(MELLIN_BINS)
+
+    def profile(a):
+        mag = np.log1p(np.abs(pl.rfft(a - a.mean()))).ravel()[inside]
+        prof = np.bincount(bins, mag, MELLIN_BINS) / counts
+        # take out the overall fall off that all image spectra share
+        return prof - np.polyval(np.polyfit(ramp, prof, 1), ramp)
+
+    sprof = profile(s.arr)
+    pprof = profile(p.arr)
+
+    biggest = min(s.arr.shape[0] / float(p.arr.shape[0]),
+                  s.arr.shape[1] / float(p.arr.shape[1]))
+    shifts = min(int(np.log(biggest) / step), MELLIN_BINS // 2)
+
+    scores = np.zeros(shifts + 1)
+    for d in range(shifts + 1):
+        a = sprof[:MELLIN_BINS-d]
+        b = pprof[d:]
+        a = a - a.mean()
+        b = b - b.mean()
+        norm = np.sqrt((a ** 2).sum() * (b ** 2).sum())
+        if norm > 0:
+            scores[d] = (a * b).sum() / norm
+
+    # best local maxima of the scores
+    padded = np.concatenate(([-np.inf], scores, [-np.inf]))
+    peaks = np.nonzero((scores >= padded[:-2]) & (scores >= padded[2:]))[0]
+    peaks = peaks[np.argsort(-scores[peaks], kind='mergesort')][:k]
+    return [float(np.exp(d * step)) for d in peaks]
+
+def climb_scales(s, p, allLowRes, fact):
+    """Find the best low-res scalings without trying all of them.
+
+    Starts from the Fourier-Mellin proposals and a ladder of scalings
+    RUNG apart, and from each of the best MELLIN_K of those climbs to
+    the best scaling nearby, halving the step each time. So the number
+    of comparisons grows with the log of how much bigger the Source is
+    than the Pattern, rather than with the number of scalings.
+
+    No scaling is ruled out by how far the spread of the resized Pattern
+    strays from that of the low-res one: resizing smooths, so that rules
+    out every scaling of a textured Pattern, the true one included.
+
+    ----------
+    s, p : Image
+       The low-res images to be compared.
+
+    allLowRes : list[tuple[int]]
+       Every low-res scaling, biggest first.
 
     fact : int
        Factor by which both Images were scaled down.
 
     ----------
-    out1 : dict
-       Scalings associated with best-bet window in the Pattern
-       for a match.
-    out2 : list[tuple[int x float]]
-       Tuple of scaling index in scatu and best match value for
-       that comparison. 
-
+    out : dict
+       Scalings associated with best-bet window in the Source for a
+       match, for every scaling tried that had one.
     """
-    windows = {}
-    maxes = []
+    height = float(p.arr.shape[0])
+    logs = np.log(np.array([sca[0] for sca in allLowRes]) / height)
+
+    def nearest(g):
+        return int(np.argmin(np.abs(logs - g)))
+
+    tried = {}
+    def rate(i):
+        if i not in tried:
+            tried[i] = rate_scaling(s, p, allLowRes[i], fact)
+        return tried[i][0]
+
+    guesses = list(np.arange(0, logs.max() + np.log(RUNG), np.log(RUNG)))
+    guesses += list(np.log(estimate_scales(s, p)))
+    starts = sorted(set(nearest(g) for g in guesses))
+    tried.update(zip(starts, thread_map(
+        lambda i: rate_scaling(s, p, allLowRes[i], fact), starts)))
+    starts.sort(key=rate, reverse=True)
+
+    for i in starts[:MELLIN_K]:
+        step = np.log(RUNG)
+        while True:
+            step /= 2
+            near = [nearest(logs[i] - step), nearest(logs[i] + step)]
+            if step * allLowRes[i][0] < 1:
+                # down to neighbouring scalings
+                near = [max(i - 1, 0), min(i + 1, len(allLowRes) - 1)]
+            best = max([i] + near, key=rate)
+            if best == i and step * allLowRes[i][0] < 1:
+                break
+            i = best
+
+    return dict((allLowRes[i], win) for i, (m, win) in tried.items() 
+                if win is not None)
+
+def rate_scaling(s, p, scaling, fact):
+    """Compare one scaling of the Pattern at low-res.
 
-    for i,scaling in enumerate(scatu):
+    ----------
+    s, p : Image
+       The low-res images to be compared.
 
-        pScaled = Pattern.resize(p, scaling)
-                
-        if abs(pScaled.arr.std() - p.stdev) > SLOP:
-            break;
+    scaling : tuple[int]
+       Low-res scaling of the Pattern.
 
-        # choose comparison method based on pScaled
-        method = choose_weapon(pScaled)
-        nn, thresh, mean = method(s, pScaled, fact)
-        
-        # post process and get the max
-        nn[nn >= 1.015] = 0
-        m = nn.max()
-        
-        mY, mX = np.where(nn >= thresh)
+    fact : int
+       Factor by which both Images were scaled down.
+
+    ----------
+    out1 : float
+       Best correlation found.
+
+    out2 : list[int]
+       Best-bet window in the Source for a match, or None.
+    """
+    pScaled = Pattern.resize(p, scaling)
+
+    # choose comparison method based on pScaled
+    method = choose_weapon(pScaled)
+    nn, thresh, mean = method(s, pScaled, fact)
+
+    mY, mX = np.where(nn >= thresh)
+    if mX.size == 0:
+        return nn.max(), None
+    return nn.max(), train_caboose(mY, mX, fact, scaling)
 
-        if mX.size > 0: 
-            windows[scaling] = train_caboose(mY, mX, fact, scaling)
-            maxes += [(i, m)]
-        
-    return windows, maxes         
-    
 
 def train_caboose(mY, mX, fact, scaling):
     """Post-processing on good looking honkies.
@@ -274,3 +367,126 @@ def find_window(mX, mY, scaling, SL=10):
         downBound = max(downBound, yi+scaling[0]+1)
 
     return (max(leftBound-SL, 0), rightBound+SL, max(upBound-SL,0), downBound+SL)
+
+def pyramid_windows(s, p, SL=10):
+    """Candidate windows for an unscaled Pattern from a low-res pass.
+
+    Compares the block averaged Pattern against the block averaged
+    Source and puts a window around every low-res hit, big enough to
+    hold the full Pattern wherever the rounding of the scale down may
+    have put it. Averaging, rather than striding, keeps a Pattern whose
+    offset is not a multiple of the factor looking like its spot in the
+    Source at low res.
+
+    ----------
+    s, p : Image
+       The images to be compared.
+
+    SL : int, optional
+       Slop level for the windows. Default is 10.
+
+    ----------
+    out1 : list[tuple[int]]
+       (left,right,up,down) windows of the Source worth a full-res look.
+
+    out2 : float
+       Threshold to hold the full-res confidences in the windows to,
+       from the mean and spread of the low-res ones (which follow the
+       full-res ones closely, where the windows' own do not).
+
+    Returns None instead if the low-res pass can't narrow things down:
+    no coarse factor, a Pattern nccsat wouldn't take, or windows 
+    covering more than PYRAMID_AREA of the Source.
+    """
+    fact = res_factor(s, p)
+    if fact == 1 or choose_weapon(p) is not nccsat:
+        return None
+
+    sd = Source.sizeDown(s, fact, average=True)
+    pd = Pattern.sizeDown(p, fact, average=True)
+    if choose_weapon(pd) is not nccsat:
+        return None
+
+    nn, thresh, mean = nccsat(sd, pd, fact)
+    hits = nn >= thresh
+
+    # a window reaches from fact+SL before its hit to fact+w+SL after
+    # it, so the low-res cells wholly inside the windows floor the area
+    # of the windows once merged, and a Source the hits are all over is
+    # given up on without merging anything
+    rows, cols = s.shape
+    h, w = p.arr.shape
+    cells = np.zeros(sd.arr.shape, bool)
+    cells[:hits.shape[0], :hits.shape[1]] = hits
+    cells = spread(cells, (1 + SL // fact, (h + SL) // fact),
+                   (1 + SL // fact, (w + SL) // fact))
+    if cells[:rows // fact, :cols // fact].sum() * fact**2 \
+       > PYRAMID_AREA * rows * cols:
+        return None
+
+    # two windows overlap just where their hits are less than ky by kx
+    # cells apart, which is where boxes that size spread from the hits
+    # touch; labelling the boxes groups the hits, and merge_windows
+    # only has the bounds of the groups left to merge (only the pyramid
+    # needs scipy.ndimage)
+    from scipy.ndimage import label, find_objects
+    ky = -(-(2*fact + h + 2*SL) // fact) - 1
+    kx = -(-(2*fact + w + 2*SL) // fact) - 1
+    groups = label(spread(hits, (0, ky - 1), (0, kx - 1)), np.ones((3, 3)))[0]
+    wins = [(max(x.start*fact - fact - SL, 0),
+             min((x.stop - 1)*fact + fact + w + SL, cols),
+             max(y.start*fact - fact - SL, 0),
+             min((y.stop - 1)*fact + fact + h + SL, rows))
+            for y, x in find_objects(groups * hits)]
+    wins = merge_windows(wins)
+
+    area = sum((x[1] - x[0]) * (x[3] - x[2]) for x in wins)
+    if area > PYRAMID_AREA * rows * cols:
+        return None
+    return wins, nccfft_thresh(mean, nn.std(), 1)
+
+def spread(a, ys, xs):
+    """Spread every true entry of a boolean matrix over a box around it.
+
+    ----------
+    a : ndarray[bool]
+       Matrix to be spread.
+
+    ys, xs : tuple[int]
+       How far the box reaches before and after each true entry, on
+       each axis.
+
+    ----------
+    out : ndarray[bool]
+       Matrix the shape of a, true wherever a box reaches.
+    """
+    (up, down), (left, right) = ys, xs
+    padded = np.pad(a, ((down, up), (right, left)), 'constant')
+    return window_sums(integral(padded),
+                       (up + down + 1, left + right + 1)) > 0
+
+def merge_windows(wins):
+    """Merge overlapping windows until none of them overlap.
+
+    ----------
+    wins : list[tuple[int]]
+       (left,right,up,down) windows.
+
+    ----------
+    out : list[tuple[int]]
+       Bounding windows of each group of overlapping windows.
+    """
+    merged = []
+    for x in wins:
+        i = 0
+        while i < len(merged):
+            m = merged[i]
+            if m[0] < x[1] and x[0] < m[1] and m[2] < x[3] and x[2] < m[3]:
+                x = (min(x[0], m[0]), max(x[1], m[1]), 
+                     min(x[2], m[2]), max(x[3], m[3]))
+                del merged[i]
+                i = 0
+            else:
+                i += 1
+        merged.append(x)
+    return merged
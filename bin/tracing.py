@@ -0,0 +1,148 @@
+# general
+import json, csv
+
+# specific
+from time import time
+from threading import local
+
+# record the stages of comparisons or not
+ON = False
+
+# events recorded in this process so far
+RECORDS = []
+
+# names of the source and pattern each thread is comparing, if any; a
+# thread loading sources ahead works on another pair than the one the
+# main thread is comparing
+PAIR = local()
+
+class Stage(object):
+    """Times a stage of a comparison, see stage."""
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def __enter__(self):
+        self.t0 = time()
+        return self
+
+    def __exit__(self, *exc):
+        note(self.name, seconds=time() - self.t0, **self.fields)
+        return False
+
+class Nothing(object):
+    """Stand in for Stage when tracing is off."""
+
+    def set(self, **fields):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NOTHING = Nothing()
+
+def stage(name, **fields):
+    """Context timing a stage of the current comparison.
+
+    Costs a function call when tracing is off.
+
+    ----------
+    name : str
+       Name of the stage.
+
+    fields : dict
+       Anything else to record with it (sizes of arrays, say); more
+       can be added with set on the context.
+
+    ----------
+    out : Stage
+       Context manager recording the stage when it exits.
+    """
+    if not ON:
+        return NOTHING
+    return Stage(name, fields)
+
+def note(name, **fields):
+    """Record an event of the current comparison (without a time)."""
+    if not ON:
+        return
+    source, pattern = current()
+    rec = {'stage':name, 'source':source, 'pattern':pattern}
+    rec.update(fields)
+    RECORDS.append(rec)
+
+def pair(source, pattern):
+    """Set the names of the images the calling thread compares from now
+    on."""
+    PAIR.names = (source, pattern)
+
+def current():
+    """Names of the images the calling thread is comparing."""
+    return getattr(PAIR, 'names', (None, None))
+
+def carry(f):
+    """f, recording under the pair of the calling thread whichever
+    thread it is run in (one of a pool, say)."""
+    if not ON:
+        return f
+    names = current()
+    def g(*args):
+        pair(*names)
+        return f(*args)
+    return g
+
+def drain():
+    """Hand over the events recorded so far, and forget them."""
+    global RECORDS
+    out, RECORDS = RECORDS, []
+    return out
+
+def summary(records):
+    """Sum up events by source, pattern and stage.
+
+    ----------
+    records : list[dict]
+       Events, as recorded by stage and note.
+
+    ----------
+    out : list[list]
+       Rows of source, pattern, engine, stage, calls, seconds and
+       count (of candidates, say), in the order first seen.
+    """
+    engines = {}
+    for rec in records:
+        if rec['stage'] == 'engine':
+            engines[(rec['source'], rec['pattern'])] = rec['engine']
+
+    rows = {}
+    order = []
+    for rec in records:
+        key = (rec['source'], rec['pattern'], rec['stage'])
+        if key not in rows:
+            rows[key] = [0, 0., 0]
+            order.append(key)
+        row = rows[key]
+        row[0] += 1
+        row[1] += rec.get('seconds', 0)
+        row[2] += rec.get('count', 0)
+    return [[s, p, engines.get((s, p)), name] + rows[(s, p, name)]
+            for s, p, name in order]
+
+def export(path, records):
+    """Write events out, as a CSV summary if path ends in .csv and as
+    a JSON list of the events otherwise."""
+    with open(path, 'wb') as fp:
+        if path.lower().endswith('.csv'):
+            w = csv.writer(fp)
+            w.writerow(['source', 'pattern', 'engine', 'stage', 'calls',
+                        'seconds', 'count'])
+            w.writerows(summary(records))
+        else:
+            json.dump(records, fp, indent=1, sort_keys=True)
@@ -1,32 +1,57 @@
 
 # general
 import numpy as np
-import sys, os
+import sys, os, json
 
 #specific
 from PIL import Image
 from time import time
+from collections import OrderedDict
+from threading import Lock
+
+# other spims
+from tracing import stage, carry
 
 
 FILETYPES = ['GIF','JPEG','PNG']
 
-def imread(fname):
-    """Read image from file. 
+# weights of red, green and blue in greyscale, as PIL has them
+LUMA = (.299, .587, .114)
 
-    Nearly verbatim of scipy.imread, but has special provision
-    to restrict input types. 
+# modes whose greyscale (convert('F')) is that of their RGB conversion;
+# others (16 bit and float greyscale, say) carry more than RGB can hold
+RGB_MODES = ['1', 'L', 'P', 'RGB', 'RGBA', 'LA', 'CMYK', 'YCbCr']
+
+# factors JPEGs can be decoded straight down by
+DRAFTS = (2, 4, 8)
+
+# threads comparisons within one source and pattern pair are spread over
+THREADS = 1
+
+# a grid cell and its neighbours, own cell first
+NEIGHBOURS = [(0,0), (-1,0), (1,0), (0,-1), (0,1), 
+              (-1,-1), (-1,1), (1,-1), (1,1)]
+
+# rolling hashes are taken modulo a prime small enough for the products
+# to fit in 64 bits, with one base per axis
+HASH_MOD = 2**31 - 1
+HASH_BASES = (1000003, 999983)
+
+def imopen(fname):
+    """Open an image file, restricted to the input types we take.
+
+    Only the header is read; nothing is decoded yet.
 
     ----------
     fname : str
-       Path to file to be read. 
+       Path to file to be opened.
 
     ----------
-    out1 : ndarray[float] 
-       Greyscale 2d array representation of the image.
-
-    out2 : ndarray[float]
-       RGG 3 depth 2d array representation of the image. 
+    out1 : file
+       The open file, for the caller to close.
 
+    out2 : Image
+       The (lazy) PIL image.
     """
     try:
         fp = open(fname, 'rb')
@@ -38,14 +63,121 @@ def imread(fname):
         if im.format not in FILETYPES:
             sys.stderr.write('IOException: Invalid image type\n')
             sys.exit(1)
-            
-    fa = np.array(im.convert('F'))
-    im = im.convert('RGB')
-    wa = np.array(im)
-    
-    fp.close()
+    return fp, im
+
+def imload(fname, im):
+    """Decode an image opened by imopen, failing as imopen does.
+
+    np.array on a PIL image that fails to decode (a truncated file,
+    say) does not raise, but gives back an empty object array, so the
+    decoding has to be done, and checked, beforehand.
+
+    ----------
+    fname : str
+       Path the image was opened from.
+
+    im : Image
+       The image, as imopen has it.
+    """
+    try:
+        im.load()
+    except:
+        sys.stderr.write('IOException: Invalid input type on '+fname+'\n')
+        sys.exit(1)
+
+def imread(fname):
+    """Read image from file. 
+
+    Nearly verbatim of scipy.imread, but has special provision
+    to restrict input types. The image is decoded to RGB once and the
+    greyscale is worked out from that (see grey), after the decoded
+    image is let go of, unless its mode holds more than RGB does (see
+    RGB_MODES), in which case PIL works the greyscale out itself.
+
+    ----------
+    fname : str
+       Path to file to be read. 
+
+    ----------
+    out1 : ndarray[float] 
+       Greyscale 2d array representation of the image.
+
+    out2 : ndarray[float]
+       RGG 3 depth 2d array representation of the image. 
 
-    return fa, wa
+    """
+    fp, im = imopen(fname)
+    with fp:
+        imload(fname, im)
+        if im.mode not in RGB_MODES:
+            return np.array(im.convert('F')), rgb(im)
+        wa = rgb(im)
+    del im
+    return grey(wa), wa
+
+def imdraft(fname, fact):
+    """Read a JPEG straight at a fraction of its size.
+
+    libjpeg can decode at 1/2, 1/4 and 1/8 size (PIL's draft mode)
+    for much less than a full decode. The arrays come out the same
+    shape as those of imread strided by fact, each pixel averaging its
+    block rather than sampling a corner of it.
+
+    ----------
+    fname : str
+       Path to file to be read. 
+
+    fact : int
+       Factor to scale down by.
+
+    ----------
+    out : tuple[ndarray]
+       Greyscale and RGB arrays as imread has them, or None if the
+       image is not a JPEG or cannot be scaled down by fact.
+    """
+    fp, im = imopen(fname)
+    with fp:
+        if im.format != 'JPEG' or fact not in DRAFTS:
+            return None
+        w, h = im.size
+        im.draft('RGB', (w // fact, h // fact))
+        if im.size != (-(-w // fact), -(-h // fact)):
+            return None
+        imload(fname, im)
+        wa = rgb(im)
+    del im
+    return grey(wa), wa
+
+def rgb(im):
+    """RGB array of a PIL image."""
+    if im.mode != 'RGB':
+        im = im.convert('RGB')
+    return np.array(im)
+
+def grey(wa, block=2**20):
+    """Greyscale of an RGB array, exactly as PIL's convert('F') has it.
+
+    Worked out a few rows at a time, to keep the (double) temporaries
+    small.
+
+    ----------
+    wa : ndarray[uint8]
+       RGB array.
+
+    block : int, optional
+       Rough number of pixels done in one go.
+
+    ----------
+    out : ndarray[float32]
+       Greyscale array.
+    """
+    fa = np.empty(wa.shape[:2], np.float32)
+    rows = max(block // max(wa.shape[1], 1), 1)
+    for y in range(0, wa.shape[0], rows):
+        w = wa[y:y+rows]
+        fa[y:y+rows] = (w[...,0] * LUMA[0] + w[...,1] * LUMA[1] 
+                        + w[...,2] * LUMA[2])
+    return fa
 
 def pad_zeroes(m, axis, thick):
     """Pads given matrix with zeros. 
@@ -95,6 +227,155 @@ def pad_to_size_of(a, b):
     a2 = pad_zeroes(a, 0, b.shape[0] - a.shape[0])
     return pad_zeroes(a2, 1, b.shape[1] - a.shape[1])
 
+def integral(a):
+    """Integral image (summed-area table) of a matrix.
+
+    ----------
+    a : ndarray
+       Matrix to be summed, accumulated in double precision.
+
+    ----------
+    out : ndarray[float]
+       Matrix one bigger than a on both axes, whose [i,j] entry is 
+       the sum of a[:i,:j].
+    """
+    ii = np.zeros((a.shape[0]+1, a.shape[1]+1))
+    np.cumsum(a, axis=0, dtype=np.float64, out=ii[1:,1:])
+    np.cumsum(ii[1:,1:], axis=1, out=ii[1:,1:])
+    return ii
+
+def block_mean(a, fact):
+    """Scale a matrix down by averaging fact by fact blocks of it.
+
+    Comes out the same shape as a[::fact,::fact], the blocks on the
+    last rows and columns averaging only what they hold of a.
+
+    ----------
+    a : ndarray
+       Matrix to be scaled down, on its first two axes.
+
+    fact : int
+       Factor to scale down by.
+
+    ----------
+    out : ndarray
+       Block means, rounded back to the type of a if it is integral.
+    """
+    rows = np.arange(0, a.shape[0], fact)
+    cols = np.arange(0, a.shape[1], fact)
+    sums = np.add.reduceat(np.add.reduceat(a, rows, axis=0, dtype=np.float64),
+                           cols, axis=1)
+    counts = np.outer(np.diff(np.append(rows, a.shape[0])),
+                      np.diff(np.append(cols, a.shape[1])))
+    out = sums / counts.reshape(counts.shape + (1,) * (a.ndim - 2))
+    if np.issubdtype(a.dtype, np.integer):
+        out = np.rint(out)
+    return out.astype(a.dtype)
+
+def window_sums(ii, shape):
+    """Sum of every window of the given shape, from an integral image.
+
+    ----------
+    ii : ndarray[float]
+       Integral image of some matrix a, see integral.
+
+    shape : tuple[int]
+       Shape of the windows.
+
+    ----------
+    out : ndarray[float]
+       Matrix whose [y,x] entry is the sum of a[y:y+h,x:x+w], for every
+       window that fits entirely inside a.
+    """
+    h, w = shape
+    return ii[h:,w:] - ii[:-h,w:] - ii[h:,:-w] + ii[:-h,:-w]
+
+def above(a, thresh, block=2**22):
+    """np.nonzero(a > thresh) of a matrix, a few rows at a time.
+
+    So that no full size mask is ever made of a big (memory mapped)
+    confidence matrix.
+
+    ----------
+    a : ndarray[float]
+       Matrix to look through.
+
+    thresh : float
+       Entries strictly above this are picked.
+
+    block : int, optional
+       Rough number of entries looked at in one go.
+
+    ----------
+    out1, out2 : ndarray[int]
+       Row and column indices of the picked entries, in row major order.
+    """
+    rows = max(block // max(a.shape[1], 1), 1)
+    ys = [np.zeros(0, int)]
+    xs = [np.zeros(0, int)]
+    for y in range(0, a.shape[0], rows):
+        by, bx = np.nonzero(a[y:y+rows] > thresh)
+        ys.append(by + y)
+        xs.append(bx)
+    return np.concatenate(ys), np.concatenate(xs)
+
+def pack_rgb(warr):
+    """Pack an RGB image into one integer per pixel.
+
+    ----------
+    warr : ndarray[uint8]
+       RGB 3 depth 2d array.
+
+    ----------
+    out : ndarray[int]
+       2d array of 0xRRGGBB values.
+    """
+    warr = warr.astype(np.int64)
+    return (warr[:,:,0] << 16) | (warr[:,:,1] << 8) | warr[:,:,2]
+
+def rolling_hashes(v, n, base):
+    """Polynomial hash of every n long run along the last axis of v.
+
+    One vectorized step per column, each hashing all of the rows.
+
+    ----------
+    v : ndarray[int]
+       2d array of values below HASH_MOD.
+
+    n : int
+       Length of the runs.
+
+    base : int
+       Base of the polynomial.
+
+    ----------
+    out : ndarray[int]
+       Array whose [i,j] entry is the hash of v[i,j:j+n].
+    """
+    prefix = np.zeros((v.shape[0], v.shape[1]+1), np.int64)
+    for j in range(v.shape[1]):
+        prefix[:,j+1] = (prefix[:,j] * base + v[:,j]) % HASH_MOD
+    top = pow(base, n, HASH_MOD)
+    return (prefix[:,n:] - prefix[:,:-n] * top) % HASH_MOD
+
+def window_hashes(v, shape):
+    """2d rolling hash of every window of the given shape.
+
+    ----------
+    v : ndarray[int]
+       2d array of values below HASH_MOD.
+
+    shape : tuple[int]
+       Shape of the windows.
+
+    ----------
+    out : ndarray[int]
+       Matrix whose [y,x] entry is the hash of v[y:y+h,x:x+w], for every
+       window that fits entirely inside v. Equal windows hash equal.
+    """
+    rows = rolling_hashes(v, shape[1], HASH_BASES[0])
+    return rolling_hashes(rows.T, shape[0], HASH_BASES[1]).T
+
 def overlaps(vals, perc=.5):
     """Eliminates overlapping vals.
 
@@ -115,27 +396,98 @@ def overlaps(vals, perc=.5):
     out : list[...]
        Same list as before with any overlapping matches removed. 
     """
-    underlaps = []
-    if len(vals) > 0:
-        underlaps.append(vals[0])
-        for val in vals:
-            i = 0
-            amount = len(underlaps)
-            inv = 1
-            while (inv):
-
-                if (i == amount):
-                    underlaps.append(val)
-                    inv = False
-                elif poverlap(underlaps[i][1], val[1],
-                              underlaps[i][2], val[2]) >= perc:
-                    if val[0] > underlaps[i][0]:
-                        underlaps[i] = val
-                    inv = False
-                else:
-                    i += 1
-  
-    return underlaps
+    with stage('overlaps', count=len(vals)):
+        keep = suppress([val[0] for val in vals], 
+                        [val[1] for val in vals],
+                        [val[2] for val in vals], perc)
+    return [vals[i] for i in keep]
+
+def suppress(conf, corners, sizes, perc=.5):
+    """Grid indexed workhorse of overlaps.
+
+    Goes through the vals in order, comparing each with the vals kept so
+    far: the first kept val it overlaps by at least perc (as poverlap
+    measures it) is replaced if it is weaker, and a val that overlaps 
+    nothing is kept. Kept vals are
+    filed in a grid of cells as big as the biggest size, so a val is
+    only compared with those in its own and the neighbouring cells; 
+    nothing further away can overlap it. When the vals come strongest
+    first nothing can ever be replaced, so any overlap will do and the
+    search stops at the first one (looking at the nearest, most 
+    recently kept vals first).
+
+    ----------
+    conf : list[float]
+       Confidence of each val.
+
+    corners : list[list[int x int]]
+       Top-left corner of each val.
+
+    sizes : list[tuple[int x int]]
+       Size of each val.
+
+    perc : float, optional
+       Percent overlap at which to throw out a worser val.
+
+    ----------
+    out : list[int]
+       Indices of the kept vals, in the order overlaps returns them.
+    """
+    if len(conf) == 0:
+        return []
+
+    ordered = all(a >= b for a, b in zip(conf, conf[1:]))
+    if perc > 0:
+        cell = max(max(sz) for sz in sizes)
+    else:
+        # everything overlaps by at least nothing, so one big cell
+        cell = float('inf')
+
+    # kept vals go in the grid as (slot, x0, y0, x1, y1), the same
+    # corners poverlap works out
+    kept = []
+    boxes = []
+    grid = {}
+
+    for i in range(len(conf)):
+        x2, y2 = corners[i]
+        x3 = x2 + sizes[i][0]
+        y3 = y2 + sizes[i][1]
+        area = 2*(sizes[i][0]*sizes[i][1])
+        cx, cy = x2 // cell, y2 // cell
+
+        # first (earliest kept) val that this one overlaps, see poverlap
+        first = None
+        for gx, gy in NEIGHBOURS:
+            slots = grid.get((cx+gx, cy+gy), ())
+            if ordered:
+                slots = reversed(slots)
+            for slot, x0, y0, x1, y1 in slots:
+                if first is not None and slot > first:
+                    continue
+                ox = (x1 if x1 < x3 else x3) - (x0 if x0 > x2 else x2)
+                oy = (y1 if y1 < y3 else y3) - (y0 if y0 > y2 else y2)
+                ol = ox * oy if ox > 0 and oy > 0 else 0
+                if ol / float(area - ol) >= perc:
+                    first = slot
+                    if ordered:
+                        break
+            if ordered and first is not None:
+                break
+
+        box = (len(kept) if first is None else first, x2, y2, x3, y3)
+        if first is None:
+            kept.append(i)
+            boxes.append(box)
+            grid.setdefault((cx, cy), []).append(box)
+        elif conf[i] > conf[kept[first]]:
+            old = boxes[first]
+            grid[(old[1] // cell, old[2] // cell)].remove(old)
+            kept[first] = i
+            boxes[first] = box
+            grid.setdefault((cx, cy), []).append(box)
+
+    return kept
 
 def poverlap(t1, t2, size1, size2):
     """Calculate percent overlap.
@@ -168,6 +520,120 @@ def poverlap(t1, t2, size1, size2):
 
     return ol / float(2*(size2[0]*size2[1]) - ol)
 
+class lazyprop(object):
+    """Attribute computed on first access and then kept on the instance.
+
+    ----------
+    func : function
+       Computes the attribute from the instance.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        val = self.func(obj)
+        obj.__dict__[self.name] = val
+        return val
+
+def sizeof(val):
+    """Bytes held by an array or a tuple of arrays."""
+    if isinstance(val, tuple):
+        return sum(sizeof(v) for v in val)
+    return getattr(val, 'nbytes', 0)
+
+class LRUCache:
+    """Least recently used cache bounded by the bytes of its values.
+
+    ----------
+    maxbytes : int
+       Total size of the cached arrays, past which the least recently
+       used entries are evicted.
+    """
+
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.store = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, make):
+        """Look up key, calling make() to fill it in on a miss.
+
+        ----------
+        key : hashable
+           Cache key.
+
+        make : function
+           Computes the value when key is not cached.
+
+        ----------
+        out : object
+           Cached (or freshly made) value.
+        """
+        with self.lock:
+            if key in self.store:
+                self.hits += 1
+                val = self.store.pop(key)
+                self.store[key] = val
+                return val
+            self.misses += 1
+
+        # made outside the lock so threads can fill in different keys
+        # at once; if two make the same one, the first to finish wins
+        val = make()
+        size = sizeof(val)
+        with self.lock:
+            if key in self.store:
+                return self.store[key]
+            if size <= self.maxbytes:
+                self.store[key] = val
+                self.nbytes += size
+                while self.nbytes > self.maxbytes:
+                    old = self.store.popitem(last=False)[1]
+                    self.nbytes -= sizeof(old)
+        return val
+
+    def clear(self):
+        with self.lock:
+            self.store.clear()
+            self.nbytes = 0
+
+_threads = {}
+
+def thread_map(f, items):
+    """map(f, items) spread over THREADS threads.
+
+    The results are in the order of items, whichever finish first. The
+    threads are kept for later calls (in each process), and trace what
+    they do under the pair of the caller (see tracing.carry).
+
+    ----------
+    f : function
+       Applied to each item.
+
+    items : list
+       Items to apply f to.
+
+    ----------
+    out : list
+       f of each item.
+    """
+    if THREADS <= 1 or len(items) <= 1:
+        return map(f, items)
+    key = (os.getpid(), THREADS)
+    if key not in _threads:
+        from multiprocessing.pool import ThreadPool
+        _threads.clear()
+        _threads[key] = ThreadPool(THREADS)
+    return _threads[key].map(carry(f), items)
+
 class Match:
 
     def __init__(self, source, pattern, x, y, prob):
@@ -189,4 +655,18 @@ class Match:
                 + " at " + str(self.w) + "x" + str(self.h) 
                 + "+" + str(self.x) + "+" + str(self.y) 
                 + " with " + str(round(self.prob, 2)) + " confidence\n")
+
+    def toJSON(self, time=None):
+        """One line JSON record of the match.
+
+        ----------
+        time : float, optional
+           Seconds spent on the source and pattern pair (see 
+           match.match_source for pairs done in a volley).
+        """
+        return json.dumps({"pattern":self.pattern, "source":self.source,
+                           "width":int(self.w), "height":int(self.h),
+                           "x":int(self.x), "y":int(self.y),
+                           "confidence":float(self.prob),
+                           "time":time}, sort_keys=True) + "\n"
     